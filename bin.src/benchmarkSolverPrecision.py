@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+
+from lsst.pipe.crowd import BenchmarkSolverPrecision
+task = BenchmarkSolverPrecision()
+task.run()
@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+
+from lsst.pipe.crowd import MakeDecapsReferenceCache
+task = MakeDecapsReferenceCache()
+task.run()
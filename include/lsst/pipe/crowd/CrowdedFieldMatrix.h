@@ -18,60 +18,127 @@ enum SolverStatus {
     FAILURE
 };
 
-template <typename PixelT>
+template <typename PixelT, typename MatrixT = PixelT>
 class CrowdedFieldMatrix {
 public:
     CrowdedFieldMatrix(const afw::image::Exposure<PixelT>& exposure,
                        ndarray::Array<double const, 1>  &x,
                        ndarray::Array<double const, 1>  &y);
 
+    // Joint fit of one source list over several exposures (epochs) sharing
+    // the same pixel grid; InvalidParameterError is thrown if their bounding
+    // boxes or WCSs differ, so overlapping visits must first be warped to a
+    // common grid. Source positions are shared between epochs; fluxes are
+    // either shared or fit separately for each epoch. When fluxes are
+    // per-epoch, the catalog fluxKey receives the first epoch and the others
+    // are available from getFluxes(epoch).
+    CrowdedFieldMatrix(const std::vector<afw::image::Exposure<PixelT>> &exposures,
+                       ndarray::Array<double const, 1>  &x,
+                       ndarray::Array<double const, 1>  &y,
+                       bool sharedFlux = false);
+
     CrowdedFieldMatrix(const afw::image::Exposure<PixelT> &exposure,
                        afw::table::SourceCatalog *catalog,
                        afw::table::Key<double> fluxKey,
                        bool fitCentroids = true,
-                       afw::table::PointKey<double> centroidKey = afw::table::PointKey<double>());
+                       afw::table::PointKey<double> centroidKey = afw::table::PointKey<double>(),
+                       afw::table::Key<double> fluxErrKey = afw::table::Key<double>());
+
+    CrowdedFieldMatrix(const std::vector<afw::image::Exposure<PixelT>> &exposures,
+                       afw::table::SourceCatalog *catalog,
+                       afw::table::Key<double> fluxKey,
+                       bool fitCentroids = true,
+                       afw::table::PointKey<double> centroidKey = afw::table::PointKey<double>(),
+                       afw::table::Key<double> fluxErrKey = afw::table::Key<double>(),
+                       bool sharedFlux = false);
 
     void _addSource(const afw::image::Exposure<PixelT> &exposure,
-                           std::vector<Eigen::Triplet<PixelT>> &matrixEntries,
+                           std::vector<Eigen::Triplet<MatrixT>> &matrixEntries,
                            int nStar, double  x, double y,
-                           PixelT estFlux=PixelT());
+                           MatrixT estFlux=MatrixT(), int epoch=0);
 
-    std::vector<Eigen::Triplet<PixelT>> _makeMatrixEntries(
-                       const afw::image::Exposure<PixelT> &exposure,
+    std::vector<Eigen::Triplet<MatrixT>> _makeMatrixEntries(
+                       const std::vector<afw::image::Exposure<PixelT>> &exposures,
                        ndarray::Array<double const, 1> &x,
                        ndarray::Array<double const, 1> &y);
 
-    std::vector<Eigen::Triplet<PixelT>> _makeMatrixEntries(
-                       const afw::image::Exposure<PixelT> &exposure,
+    std::vector<Eigen::Triplet<MatrixT>> _makeMatrixEntries(
+                       const std::vector<afw::image::Exposure<PixelT>> &exposures,
                        afw::table::SourceCatalog *catalog);
 
     SolverStatus solve();
 
-    const std::list<std::tuple<int, int, PixelT>> getMatrixEntries();
-    const Eigen::Matrix<PixelT, Eigen::Dynamic, 1> makeDataVector();
-    const Eigen::Matrix<PixelT, Eigen::Dynamic, 1> getDataVector();
+    // Solve with the matrix stored at MatrixT precision, but with the
+    // conjugate gradient vectors and products accumulated in double.
+    void setMixedPrecision(bool mixedPrecision);
+
+    // Re-evaluate the matrix for a catalog with updated source positions.
+    // If the new catalog covers exactly the same pixels and parameters, only
+    // the numeric values of the existing sparse matrix are refilled and the
+    // next solve starts from the previous solution. If the sources are the
+    // same but cover different pixels, the newly evaluated entries are kept
+    // and only the data vector and the compressed matrix are rebuilt, again
+    // with a warm start. A catalog with a different number of sources is
+    // rebuilt from scratch. Returns true if the structure was reused.
+    bool updateCatalog(afw::table::SourceCatalog *catalog);
+    void setFluxErrKey(afw::table::Key<double> fluxErrKey);
+
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> computeFluxVariance(int epoch = 0);
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> getFluxes(int epoch = 0);
+
+    const std::list<std::tuple<int, int, MatrixT>> getMatrixEntries();
+    const Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> makeDataVector();
+    const Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> getDataVector();
 
     const std::map<std::tuple<int, int>, int> getParameterMapping();
-    const std::map<std::tuple<int, int>, int> getPixelMapping();
+    const std::map<std::tuple<int, int>, int> getPixelMapping(int epoch = 0);
+
+    int nEpochs();
 
     int iterations();
 
-    Eigen::Matrix<PixelT, Eigen::Dynamic, 1> result();
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> result();
 
 private:
 
-    const afw::image::Exposure<PixelT> _exposure;
+    // Flux parameter index for a given epoch.
+    int _fluxParameter(int epoch);
+
+    void _checkExposures(const std::vector<afw::image::Exposure<PixelT>> &exposures);
+    MatrixT _estimatePsfFlux(const afw::image::Exposure<PixelT> &exposure, double x, double y);
+
+    void _buildMatrix();
+    Eigen::VectorXd _solveMixedPrecision(const Eigen::VectorXd &guess);
+    bool _hasSamePattern(const std::vector<Eigen::Triplet<MatrixT>> &matrixEntries);
+
+    const std::vector<afw::image::Exposure<PixelT>> _exposures;
     afw::table::SourceCatalog *_catalog;
     afw::table::Key<double> _fluxKey;
     const bool _fitCentroids;
+    // If true, each source has one flux shared across all exposures,
+    // otherwise it has one flux per exposure. Positions are always shared.
+    const bool _sharedFlux;
+    const int _nFluxParameters;
     afw::table::PointKey<double> _centroidKey;
+    afw::table::Key<double> _fluxErrKey;
     ParameterTracker _paramTracker;
     int _iterations;
     int _maxIterations;
-    Eigen::Matrix<PixelT, Eigen::Dynamic, 1> _result;
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> _result;
+
+    std::vector<Eigen::Triplet<MatrixT>> _matrixEntries;
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> _dataVector;
+
+    // Inverse variance of each matrix row, used for the flux uncertainties.
+    std::vector<double> _pixelWeights;
 
-    std::vector<Eigen::Triplet<PixelT>> _matrixEntries;
-    Eigen::Matrix<PixelT, Eigen::Dynamic, 1> _dataVector;
+    // Compressed matrix built from _matrixEntries, and the position of each
+    // entry in its value array so the values can be refilled in place.
+    Eigen::SparseMatrix<MatrixT> _paramMatrix;
+    std::vector<int> _valueIndex;
+    bool _matrixIsBuilt;
+    bool _useWarmStart;
+    bool _mixedPrecision;
 
 };
 
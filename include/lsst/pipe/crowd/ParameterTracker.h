@@ -14,17 +14,18 @@ public:
 
     void addSource(int sourceId);
 
-    int makePixelId(int pixelX, int pixelY);
-    int* getPixelId(int pixelX, int pixelY);
+    int makePixelId(int pixelX, int pixelY, int epoch = 0);
+    int* getPixelId(int pixelX, int pixelY, int epoch = 0);
 
     int getSourceParameterId(int sourceId, int param);
 
     // For debugging.
     std::map<std::tuple<int, int>, int> getParameterMapping();
-    std::map<std::tuple<int, int>, int> getPixelMapping();
+    std::map<std::tuple<int, int>, int> getPixelMapping(int epoch = 0);
 
     int nRows();
     int nColumns();
+    int nSources();
 
 private:
 
@@ -32,8 +33,8 @@ private:
     int _nSources;
     int _nPixels;
 
-    // image X,Y pixel -> matrix row
-    std::map<std::tuple<int, int>, int> _pixelMapping;
+    // image X,Y pixel -> matrix row, one mapping per epoch
+    std::vector<std::map<std::tuple<int, int>, int>> _pixelMappings;
 
     // sourceId, ParamId -> matrix column
     std::map<std::tuple<int, int>, int> _sourceParameterMapping;
@@ -3,9 +3,13 @@
 from .version import *  # Generated by sconsUtils
 
 from .crowd import CrowdedFieldTask, CrowdedFieldTaskConfig
-from .crowdedFieldMatrix import CrowdedFieldMatrix
+from .forced import CrowdedFieldForcedTask, CrowdedFieldForcedTaskConfig
+from .crowdedFieldMatrix import CrowdedFieldMatrix, CrowdedFieldMatrixD
 from .modelImage import ModelImageTask, ModelImageTaskConfig
+from .matching import matchPositions
+from .benchmark import BenchmarkSolverPrecision
 from .analysis import MakeDecapsMatchedCatalog, MakeDecapsPlots, MakeSummaryPlots
+from .analysis import DecapsReferenceCache, MakeDecapsReferenceCache
 
 
 
@@ -3,8 +3,18 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import argparse
-import pickle
+import collections
 import glob
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pickle
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import healpy as hp
 from astropy.io import ascii
 
 from lsst.daf.persistence import Butler
@@ -14,223 +24,741 @@ from astropy.table import Table
 from astropy.coordinates import SkyCoord
 from scipy.spatial import cKDTree
 
+import lsst.geom as geom
+import lsst.afw.table as afwTable
+
+from .matching import matchPositions, selectUniqueMatches
+
+
+def _unitVectors(ra, dec):
+    """Unit vectors for arrays of ra, dec in radians."""
+    cos_dec = np.cos(dec)
+    return np.stack((cos_dec*np.cos(ra), cos_dec*np.sin(ra), np.sin(dec)), axis=1)
+
+
+class DecapsReferenceCache:
+    """DECaPS catalogs partitioned into HEALPix cells with a spatial index.
+
+    The cache is built once from the crowdsource catalogs with `build`. Each
+    (nested) HEALPix cell is stored as a Parquet table of its sources plus a
+    pickled `~scipy.spatial.cKDTree` over their unit vectors. `query` loads
+    only the cells overlapping a detector's sky footprint, and keeps them in
+    memory so that overlapping visits reuse them, up to ``max_cells`` cells.
+    """
+
+    def __init__(self, path, nside=64, max_cells=256):
+        self.path = path
+        self.nside = nside
+        # Loaded cells, least recently used first.
+        self.max_cells = max_cells
+        self._cells = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cellDir(self):
+        return os.path.join(self.path, f"nside{self.nside:d}")
+
+    def _cellFilenames(self, pixel):
+        base = os.path.join(self._cellDir(), f"cell_{pixel:d}")
+        return base + ".parquet", base + ".kdtree.pkl"
+
+    def build(self, crowdsource_filenames):
+        """Partition the {detector}_CAT extensions of the given crowdsource
+        files by sky cell and write each cell with its spatial index."""
+        parts_dir = os.path.join(self._cellDir(), "parts")
+        os.makedirs(parts_dir, exist_ok=True)
+
+        for file_number, filename in enumerate(crowdsource_filenames):
+            with fits.open(filename, memmap=True) as crowdsource_file:
+                for hdu in crowdsource_file:
+                    if not hdu.name.endswith("_CAT"):
+                        continue
+                    table = Table(hdu.data)
+                    table = table[[name for name in table.colnames if table[name].ndim == 1]]
+                    table = table.to_pandas()
+                    table['catalog'] = os.path.basename(filename)
+                    pixels = hp.ang2pix(self.nside, table['ra'].to_numpy(),
+                                        table['dec'].to_numpy(), nest=True, lonlat=True)
+                    for pixel, cell_table in table.groupby(pixels):
+                        cell_table.to_parquet(
+                            os.path.join(parts_dir, f"{pixel:d}_{file_number:d}_{hdu.name}.parquet"),
+                            index=False)
+
+        part_filenames = {}
+        for filename in glob.glob(os.path.join(parts_dir, "*.parquet")):
+            pixel = int(os.path.basename(filename).split("_")[0])
+            part_filenames.setdefault(pixel, []).append(filename)
+
+        for pixel, filenames in part_filenames.items():
+            cell_table = pd.concat([pd.read_parquet(filename) for filename in filenames],
+                                   ignore_index=True)
+            tree = cKDTree(_unitVectors(np.radians(cell_table['ra'].to_numpy()),
+                                        np.radians(cell_table['dec'].to_numpy())))
+            table_filename, tree_filename = self._cellFilenames(pixel)
+            cell_table.to_parquet(table_filename, index=False)
+            with open(tree_filename, "wb") as f:
+                pickle.dump(tree, f)
+            for filename in filenames:
+                os.remove(filename)
+        os.rmdir(parts_dir)
+
+    def _loadCell(self, pixel):
+        """Return the persisted (table, tree) of a cell, or None if the cell
+        is empty."""
+        with self._lock:
+            if pixel in self._cells:
+                self._cells.move_to_end(pixel)
+                return self._cells[pixel]
+
+            table_filename, tree_filename = self._cellFilenames(pixel)
+            if not os.path.exists(table_filename):
+                cell = None
+            else:
+                with open(tree_filename, "rb") as f:
+                    cell = (pd.read_parquet(table_filename), pickle.load(f))
+            self._cells[pixel] = cell
+            while len(self._cells) > self.max_cells:
+                self._cells.popitem(last=False)
+            return cell
+
+    def emptyTable(self):
+        """Zero-row table with the columns of the cached cells, or None if
+        the cache is empty."""
+        filenames = glob.glob(os.path.join(self._cellDir(), "cell_*.parquet"))
+        if len(filenames) == 0:
+            return None
+        return pq.read_schema(filenames[0]).empty_table().to_pandas()
+
+    def query(self, wcs, bbox, reference_catalog=None):
+        """Return (table, tree, selected) for the cells overlapping the sky
+        footprint of bbox.
+
+        The cell tables and trees are shared between queries; if
+        reference_catalog is given, ``selected`` flags the rows that come
+        from that crowdsource catalog, otherwise it is None.
+        """
+        corners = [wcs.pixelToSky(corner) for corner in geom.Box2D(bbox).getCorners()]
+        vertices = np.array([hp.ang2vec(corner.getRa().asDegrees(), corner.getDec().asDegrees(),
+                                        lonlat=True) for corner in corners])
+        pixels = hp.query_polygon(self.nside, vertices, inclusive=True, nest=True)
+
+        cells = []
+        for pixel in pixels:
+            cell = self._loadCell(pixel)
+            if cell is None:
+                continue
+            table, tree = cell
+            selected = None
+            if reference_catalog is not None:
+                selected = (table['catalog'] == reference_catalog).to_numpy()
+                if not selected.any():
+                    continue
+            cells.append((table, tree, selected))
+        return cells
+
+
+class MakeDecapsReferenceCache:
+
+    def run(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--nside", type=int, default=64)
+        parser.add_argument("cache", type=str)
+        parser.add_argument("crowdsource_catalogs", type=str, nargs="+")
+
+        args = parser.parse_args()
+
+        DecapsReferenceCache(args.cache, nside=args.nside).build(args.crowdsource_catalogs)
+
 
 class MakeDecapsMatchedCatalog:
 
+    # Each in-flight detector holds its image-derived catalogs and matched
+    # table in memory, so the default parallelism is capped rather than
+    # following the number of cores.
+    max_default_workers = 8
+
+    def __init__(self):
+        # astropy loads HDU data lazily and is not safe to do so from
+        # several threads at once.
+        self._hdu_lock = threading.Lock()
 
     def run(self):
         parser = argparse.ArgumentParser()
         parser.add_argument("--use-src-catalog", action="store_true")
+        parser.add_argument("--num-workers", type=int, default=None,
+                            help="Number of detectors to match in parallel; memory use grows "
+                                 "with this. Defaults to the number of cores, at most "
+                                 f"{MakeDecapsMatchedCatalog.max_default_workers}.")
+        parser.add_argument("--stream-output", action="store_true",
+                            help="Write each detector to the output as soon as it is matched.")
+        parser.add_argument("--reference-cache", type=str, default=None,
+                            help="Match against this DecapsReferenceCache on the sky instead of "
+                                 "reading crowdsource_catalog. If crowdsource_catalog is also "
+                                 "given, only the cached sources from it are used.")
         parser.add_argument("visit", type=int)
         parser.add_argument("repo", type=str)
-        parser.add_argument("crowdsource_catalog", type=str)
+        parser.add_argument("crowdsource_catalog", type=str, nargs="?", default=None)
 
         args = parser.parse_args()
+        if(args.crowdsource_catalog is None and args.reference_cache is None):
+            parser.error("crowdsource_catalog is required unless --reference-cache is given")
 
         butler = Butler(args.repo)
+        reference_cache = None
+        if(args.reference_cache):
+            reference_cache = DecapsReferenceCache(args.reference_cache)
         if(args.use_src_catalog):
             self.matchVisit(butler, args.visit,
                             crowdsource_filename=args.crowdsource_catalog,
                             catalog_datatype="src",
-                            base_output_name="combined_visit_src")
+                            base_output_name="combined_visit_src",
+                            num_workers=args.num_workers,
+                            stream_output=args.stream_output,
+                            reference_cache=reference_cache)
         else:
             self.matchVisit(butler, args.visit,
                             crowdsource_filename=args.crowdsource_catalog,
                             catalog_datatype="crowdedsrc",
-                            base_output_name="combined_visit")
+                            base_output_name="combined_visit",
+                            num_workers=args.num_workers,
+                            stream_output=args.stream_output,
+                            reference_cache=reference_cache)
 
 
     def matchVisit(self, butler, visitId, crowdsource_filename,
                    base_output_name="combined_visit",
-                   catalog_datatype=None):
+                   catalog_datatype=None, num_workers=None,
+                   stream_output=False, reference_cache=None):
 
         # crowdsource_filename = "catalogs_decaps/c4d_160317_001229_ooi_g_v1.cat.fits"
-        camera = butler.get("camera")
-
-        match_tables = []
+        dataRefs = []
         for n in range(1, 63):
             if(not butler.datasetExists(catalog_datatype, visit=visitId, ccd=n)):
                 continue
-            dataRef = butler.dataRef(catalog_datatype, visit=visitId, ccd=n)
-            sensor_match = self.matchDetector(dataRef, crowdsource_filename,
-                                              catalog_datatype=catalog_datatype)
-            match_tables.append(sensor_match)
-
-        combined_table = pd.concat(match_tables)
-        combined_table.to_parquet("{:s}_{:d}.parquet".format(base_output_name, visitId))
-
-
-    def matchDetector(self, sensorRef, crowdsource_filename,
+            dataRefs.append(butler.dataRef(catalog_datatype, visit=visitId, ccd=n))
+
+        output_filename = "{:s}_{:d}.parquet".format(base_output_name, visitId)
+
+        # Streamed output needs its schema before any detector is matched.
+        stack_template = None
+        if stream_output and len(dataRefs) > 0:
+            stack_template = afwTable.SourceCatalog(dataRefs[0].get(catalog_datatype).schema)
+
+        if reference_cache is not None:
+            reference_catalog = None
+            if crowdsource_filename:
+                reference_catalog = os.path.basename(crowdsource_filename)
+            matches = self._iterMatches(
+                dataRefs,
+                lambda dataRef: self.matchDetectorSky(dataRef, reference_cache,
+                                                      reference_catalog=reference_catalog,
+                                                      catalog_datatype=catalog_datatype),
+                num_workers)
+            schema = None
+            if stack_template is not None:
+                crowd_template = reference_cache.emptyTable()
+                if crowd_template is None:
+                    crowd_template = pd.DataFrame(index=pd.RangeIndex(0))
+                schema = self._matchSchema(stack_template, crowd_template)
+            self._writeMatches(matches, output_filename, stream_output, schema)
+            return
+
+        # The crowdsource file is opened once per visit and memory-mapped;
+        # each detector's HDU is only read when that detector is matched.
+        with fits.open(crowdsource_filename, memmap=True) as crowdsource_file:
+            matches = self._iterMatches(
+                dataRefs,
+                lambda dataRef: self.matchDetector(dataRef, crowdsource_file,
+                                                   catalog_datatype=catalog_datatype),
+                num_workers)
+            schema = None
+            if stack_template is not None:
+                cat_hdu = next(hdu for hdu in crowdsource_file if hdu.name.endswith("_CAT"))
+                crowd_template = Table(cat_hdu.data[:0]).to_pandas()
+                schema = self._matchSchema(stack_template, crowd_template)
+            self._writeMatches(matches, output_filename, stream_output, schema)
+
+    def _writeMatches(self, matches, output_filename, stream_output, schema=None):
+        if(stream_output):
+            if schema is None:
+                # No detectors to match.
+                return
+            self._writeStreaming((table for _, table in matches), output_filename, schema)
+        else:
+            match_tables = [table for _, table in sorted(matches, key=lambda x: x[0])]
+            combined_table = pd.concat(match_tables)
+            combined_table.to_parquet(output_filename)
+
+    def _iterMatches(self, dataRefs, match_function, num_workers=None):
+        """Run match_function over dataRefs on a thread pool, yielding
+        (index, table) pairs in the order they finish.
+
+        At most num_workers detectors are in flight at once, so matched
+        tables are not accumulated faster than they are consumed and memory
+        use is bounded by num_workers detectors. The default is the number
+        of cores, capped at max_default_workers.
+        """
+        if num_workers is None:
+            num_workers = min(os.cpu_count() or 1, self.max_default_workers)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pending = set()
+            for n, dataRef in enumerate(dataRefs):
+                if(len(pending) >= num_workers):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(executor.submit(
+                    lambda n, dataRef: (n, match_function(dataRef)), n, dataRef))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def _matchSchema(self, stack_template, crowd_template):
+        """Arrow schema of the matched tables of a visit.
+
+        Zero-row stack and crowdsource tables are put through the same merge
+        as each detector. The outer merge fills unmatched rows with NaN, so
+        integer columns are stored as float64 and booleans as nullable bool.
+        visit and ccd are always set and stay int64.
+        """
+        merged = self._mergeMatches({'visit': 0, 'ccd': 0}, stack_template, crowd_template,
+                                    np.zeros(0, dtype=np.int64),
+                                    np.zeros(0, dtype=np.int64), np.zeros(0))
+        fields = []
+        for name, dtype in merged.dtypes.items():
+            if name in ("visit", "ccd"):
+                field_type = pa.int64()
+            elif pd.api.types.is_bool_dtype(dtype):
+                field_type = pa.bool_()
+            elif pd.api.types.is_integer_dtype(dtype):
+                field_type = pa.float64()
+            elif pd.api.types.is_float_dtype(dtype):
+                field_type = pa.from_numpy_dtype(dtype)
+            else:
+                field_type = pa.string()
+            fields.append(pa.field(name, field_type))
+        return pa.schema(fields)
+
+    def _writeStreaming(self, match_tables, output_filename, schema):
+        """Append each matched table to a Parquet file as its own row group.
+
+        Every table is written with the given schema: columns a detector
+        lacks (e.g. the DECaPS columns of a detector without reference
+        sources) are written as nulls. Each row group holds a single
+        detector, so the row group statistics on the visit and ccd columns
+        allow predicate pushdown.
+        """
+        with pq.ParquetWriter(output_filename, schema) as writer:
+            for table in match_tables:
+                if(len(table) == 0):
+                    continue
+                extra_columns = set(table.columns) - set(schema.names)
+                if extra_columns:
+                    print("Dropping columns not in the output schema: " + ", ".join(sorted(extra_columns)))
+                columns = {}
+                for field in schema:
+                    if field.name not in table.columns:
+                        columns[field.name] = pd.Series(None, index=table.index, dtype=object)
+                    elif pa.types.is_boolean(field.type):
+                        columns[field.name] = table[field.name].astype("boolean")
+                    else:
+                        columns[field.name] = table[field.name]
+                arrow_table = pa.Table.from_pandas(pd.DataFrame(columns, index=table.index),
+                                                   schema=schema, preserve_index=False)
+                writer.write_table(arrow_table, row_group_size=len(arrow_table))
+
+    def matchDetector(self, sensorRef, crowdsource_file,
                       max_dist_pixels=1.5, catalog_datatype="crowdedsrc"):
+        """Match one detector's catalog to its DECaPS counterpart.
+
+        crowdsource_file is the opened (memory-mapped) crowdsource
+        `~astropy.io.fits.HDUList` for the whole visit.
+        """
         detector = sensorRef.get("calexp_detector")
 
         detector_name = detector.getName()
 
-        crowdsource_file = fits.open(crowdsource_filename)
-
-        crowdsource_table = Table.read(crowdsource_filename,
-                                       hdu=f"{detector_name}_CAT")
-
-        crowd_tree = cKDTree(np.stack((crowdsource_table['x'],
-                                       crowdsource_table['y']), axis=1))
+        with self._hdu_lock:
+            crowdsource_data = crowdsource_file[f"{detector_name}_CAT"].data
+        crowdsource_table = Table(crowdsource_data)
 
         stack_table = sensorRef.get(catalog_datatype)
-        stack_tree = cKDTree(np.stack((stack_table['slot_Centroid_y'],
-                                       stack_table['slot_Centroid_x']), axis=1))
 
-        matches = stack_tree.query_ball_tree(crowd_tree, max_dist_pixels)
-        idx_pairs = list((x,y[0]) for x,y in zip(range(len(stack_table)),
-                                                 matches) if len(y) > 0)
-        stack_idx = np.array(list(x[0] for x in idx_pairs))
-        crowd_idx = np.array(list(x[1] for x in idx_pairs))
-        print("Matches: {:d}".format(len(idx_pairs)))
-
-        crowd_unmatched_idx = (set(range(len(crowdsource_table)))
-                                - set(x[1] for x in idx_pairs))
-        stack_unmatched_idx = (set(range(len(stack_table)))
-                                - set(x[0] for x in idx_pairs))
+        stack_idx, crowd_idx, match_distance = matchPositions(
+            np.stack((stack_table['slot_Centroid_y'],
+                      stack_table['slot_Centroid_x']), axis=1),
+            np.stack((crowdsource_table['x'],
+                      crowdsource_table['y']), axis=1),
+            max_dist_pixels)
+        print("Matches: {:d}".format(len(stack_idx)))
+
+        return self._mergeMatches(sensorRef.dataId, stack_table, crowdsource_table.to_pandas(),
+                                  stack_idx, crowd_idx, match_distance)
+
+    def matchDetectorSky(self, sensorRef, reference_cache, reference_catalog=None,
+                         max_dist_pixels=1.5, catalog_datatype="crowdedsrc"):
+        """Match one detector's catalog to DECaPS on the sky, using the
+        cached reference cells that overlap the detector.
+
+        Only reference sources inside the detector bounding box are kept.
+        """
+        wcs = sensorRef.get("calexp_wcs")
+        bbox = sensorRef.get("calexp_bbox")
+        stack_table = sensorRef.get(catalog_datatype)
 
+        cells = reference_cache.query(wcs, bbox, reference_catalog=reference_catalog)
+        if(len(cells) == 0):
+            return self._mergeMatches(sensorRef.dataId, stack_table, pd.DataFrame(index=pd.RangeIndex(0)),
+                                      np.zeros(0, dtype=np.int64),
+                                      np.zeros(0, dtype=np.int64), np.zeros(0))
+
+        # Nearest selected reference over all the cells, using each cell's
+        # persisted index. Every neighbour within the match radius is
+        # considered, so that a catalog selection does not hide a match
+        # behind a closer source from another catalog.
+        pixel_scale = wcs.getPixelScale().asRadians()
+        max_chord = 2*np.sin(0.5*max_dist_pixels*pixel_scale)
+        stack_vectors = _unitVectors(np.asarray(stack_table['coord_ra']),
+                                     np.asarray(stack_table['coord_dec']))
+        best_chord = np.full(len(stack_table), np.inf)
+        best_idx = np.full(len(stack_table), -1, dtype=np.int64)
+        offset = 0
+        for cell_table, cell_tree, selected in cells:
+            neighbours = cell_tree.query_ball_point(stack_vectors, r=max_chord)
+            counts = np.array([len(n) for n in neighbours], dtype=np.int64)
+            if counts.sum() > 0:
+                ref_idx = np.concatenate([n for n in neighbours if len(n) > 0]).astype(np.int64)
+                source_idx = np.repeat(np.arange(len(stack_table)), counts)
+                if selected is not None:
+                    keep = selected[ref_idx]
+                    ref_idx = ref_idx[keep]
+                    source_idx = source_idx[keep]
+                chord = np.linalg.norm(cell_tree.data[ref_idx] - stack_vectors[source_idx], axis=1)
+                # Nearest candidate in this cell for each source.
+                order = np.lexsort((chord, source_idx))
+                _, first = np.unique(source_idx[order], return_index=True)
+                nearest = order[first]
+                source_idx, ref_idx, chord = source_idx[nearest], ref_idx[nearest], chord[nearest]
+                closer = chord < best_chord[source_idx]
+                best_chord[source_idx[closer]] = chord[closer]
+                best_idx[source_idx[closer]] = ref_idx[closer] + offset
+            offset += len(cell_table)
+
+        crowd_pandas = pd.concat([cell_table for cell_table, _, _ in cells], ignore_index=True)
+        ref_x, ref_y = wcs.skyToPixelArray(crowd_pandas['ra'].to_numpy(),
+                                           crowd_pandas['dec'].to_numpy(), degrees=True)
+        pixel_box = geom.Box2D(bbox)
+        inside = ((ref_x >= pixel_box.getMinX()) & (ref_x < pixel_box.getMaxX()) &
+                  (ref_y >= pixel_box.getMinY()) & (ref_y < pixel_box.getMaxY()))
+        if reference_catalog is not None:
+            inside &= np.concatenate([selected for _, _, selected in cells])
+
+        matched = np.isfinite(best_chord)
+        matched[matched] = inside[best_idx[matched]]
+        stack_idx = np.flatnonzero(matched)
+        new_index = np.cumsum(inside) - 1
+        match_distance = 2*np.arcsin(0.5*best_chord[stack_idx])/pixel_scale
+        stack_idx, crowd_idx, match_distance = selectUniqueMatches(
+            stack_idx, new_index[best_idx[stack_idx]], match_distance)
+        print("Matches: {:d}".format(len(stack_idx)))
+
+        crowd_pandas = crowd_pandas[inside].reset_index(drop=True)
+        return self._mergeMatches(sensorRef.dataId, stack_table, crowd_pandas,
+                                  stack_idx, crowd_idx, match_distance)
+
+    def _mergeMatches(self, dataId, stack_table, crowd_pandas,
+                      stack_idx, crowd_idx, match_distance):
         stack_pandas = stack_table.asAstropy().to_pandas()
-        crowd_pandas = crowdsource_table.to_pandas()
 
-        stack_pandas['visit'] = sensorRef.dataId['visit']
-        stack_pandas['ccd'] = sensorRef.dataId['ccd']
         stack_pandas['key'] = np.nan
         stack_pandas.loc[stack_idx, 'key'] = crowd_idx
+        stack_pandas['match_distance'] = np.nan
+        stack_pandas.loc[stack_idx, 'match_distance'] = match_distance
         combined_total = pd.merge(stack_pandas, crowd_pandas, left_on="key",
                                   right_index=True, how="outer")
+        # Set after the merge so that unmatched DECaPS rows are labelled too.
+        combined_total['visit'] = np.int64(dataId['visit'])
+        combined_total['ccd'] = np.int64(dataId['ccd'])
 
         return combined_total
 
 
+class MetricsStore:
+    """Parquet dataset of per-visit metrics, partitioned by run label.
+
+    Each `append` writes a new file into the ``run=<label>`` partition under
+    a temporary name and then renames it into place, so concurrent writers
+    never share a file and readers never see a partial one. Reading the
+    store returns every visit of the requested runs in a single table.
+    """
+
+    # Declared rather than inferred, so that numeric run labels are not
+    # read back as integers.
+    partitioning = ds.partitioning(pa.schema([("run", pa.string())]), flavor="hive")
+
+    def __init__(self, path):
+        self.path = path
+
+    def _partition(self, run_label):
+        return os.path.join(self.path, f"run={run_label}")
+
+    def _writeAtomic(self, table, partition):
+        name = f"part-{uuid.uuid4().hex}.parquet"
+        # Files starting with "." are ignored by Parquet dataset readers.
+        tmp_filename = os.path.join(partition, f".{name}.tmp")
+        table.to_parquet(tmp_filename, index=False)
+        os.replace(tmp_filename, os.path.join(partition, name))
+
+    def append(self, run_label, metrics):
+        """Add one visit's metrics dict to the run_label partition."""
+        partition = self._partition(run_label)
+        os.makedirs(partition, exist_ok=True)
+        table = pd.DataFrame([metrics])
+        table['written'] = time.time_ns()
+        self._writeAtomic(table, partition)
+
+    def read(self, run_labels=None):
+        """Read the metrics for the given run labels (all runs if None).
+
+        If a visit was written more than once for a run, only the most
+        recent entry is returned.
+        """
+        filters = None
+        if run_labels is not None:
+            filters = [("run", "in", list(run_labels))]
+        table = pq.read_table(self.path, partitioning=self.partitioning, filters=filters).to_pandas()
+        table = table.sort_values("written").drop_duplicates(["run", "visit"], keep="last")
+        return table.reset_index(drop=True)
+
+    def compact(self, run_label):
+        """Merge the files of one partition into a single file.
+
+        Files appended while compacting are left in place. Compactions of
+        the same partition may overlap: files another compaction has already
+        removed are skipped, and any entries merged twice are resolved by
+        `read`, which keeps one entry per visit.
+        """
+        partition = self._partition(run_label)
+        filenames = sorted(glob.glob(os.path.join(partition, "part-*.parquet")))
+        if(len(filenames) <= 1):
+            return
+        tables = []
+        merged_filenames = []
+        for filename in filenames:
+            try:
+                tables.append(pd.read_parquet(filename))
+            except FileNotFoundError:
+                continue
+            merged_filenames.append(filename)
+        if(len(tables) <= 1):
+            return
+        self._writeAtomic(pd.concat(tables), partition)
+        for filename in merged_filenames:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+
+class CompletenessHistogram:
+    """Accumulate completeness histograms over many matched catalogs.
+
+    Matched Parquet catalogs are read in fixed-size batches and only the
+    columns needed here are loaded, so memory use is independent of the
+    number of rows and of how the file was written. Counts are kept per
+    visit and can be combined.
+    """
+
+    columns = ["id", "decapsid", "flux", "ccd", "visit"]
+    batch_size = 65536
+
+    def __init__(self, mag_range=(-18, -6), n_bins=20):
+        self.bins = np.linspace(mag_range[0], mag_range[1], n_bins + 1)
+        self._counts = {}
+        self._ccds = {}
+
+    @property
+    def visits(self):
+        return sorted(self._counts.keys())
+
+    def add_file(self, filename, visit=None):
+        """Add a matched catalog; visit overrides the catalog's visit column.
+
+        Catalogs written before the visit column was filled on every row
+        have NaN visits on the DECaPS-only rows; those must be given an
+        explicit visit.
+        """
+        parquet_file = pq.ParquetFile(filename)
+        columns = [name for name in self.columns
+                   if name != "visit" or visit is None]
+        for record_batch in parquet_file.iter_batches(batch_size=self.batch_size, columns=columns):
+            batch = record_batch.to_pandas()
+            if visit is not None:
+                batch_visit = np.full(len(batch), visit, dtype=np.int64)
+            else:
+                batch_visit = batch['visit'].to_numpy(dtype=float)
+                if not np.all(np.isfinite(batch_visit)):
+                    raise ValueError(f"{filename} has rows without a visit; "
+                                     "pass the visit explicitly.")
+                batch_visit = batch_visit.astype(np.int64)
+            self.add_batch(batch_visit, batch['id'].to_numpy(dtype=float),
+                           batch['decapsid'].to_numpy(dtype=float),
+                           batch['flux'].to_numpy(dtype=float),
+                           batch['ccd'].to_numpy(dtype=float))
+
+    def add_batch(self, visit, id, decapsid, flux, ccd):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mag = -2.5*np.log10(flux)
+        finite_mag = np.isfinite(mag)
+
+        sel_crowdsource = decapsid > 0
+        sel_stack = id > 0
+        sel_matches = sel_stack & sel_crowdsource
+        sel_missing_from_stack = (~sel_stack) & sel_crowdsource
+
+        for v in np.unique(visit):
+            in_visit = (visit == v)
+            counts = self._counts.setdefault(v, {"total": np.zeros(len(self.bins) - 1, dtype=np.int64),
+                                                 "matches": np.zeros(len(self.bins) - 1, dtype=np.int64),
+                                                 "missing": np.zeros(len(self.bins) - 1, dtype=np.int64),
+                                                 "n_matches": 0, "n_stack": 0, "n_decaps": 0,
+                                                 "n_missing_from_stack": 0})
+            for name, sel in [("total", sel_crowdsource), ("matches", sel_matches),
+                              ("missing", sel_missing_from_stack)]:
+                counts[name] += np.histogram(mag[in_visit & sel & finite_mag], bins=self.bins)[0]
+
+            counts["n_matches"] += int(np.sum(in_visit & sel_matches))
+            counts["n_stack"] += int(np.sum(in_visit & sel_stack))
+            counts["n_decaps"] += int(np.sum(in_visit & sel_crowdsource))
+            counts["n_missing_from_stack"] += int(np.sum(in_visit & sel_missing_from_stack))
+
+            visit_ccds = ccd[in_visit]
+            self._ccds.setdefault(v, set()).update(
+                np.unique(visit_ccds[visit_ccds >= 0]).astype(int).tolist())
+
+    def histograms(self, visit=None):
+        """Return (total, matches, missing) counts for one visit, or summed
+        over all visits if visit is None."""
+        visits = self.visits if visit is None else [visit]
+        total, matches, missing = (np.zeros(len(self.bins) - 1, dtype=np.int64) for _ in range(3))
+        for v in visits:
+            total += self._counts[v]["total"]
+            matches += self._counts[v]["matches"]
+            missing += self._counts[v]["missing"]
+        return total, matches, missing
+
+    def metrics(self, visit):
+        counts = self._counts[visit]
+        return {"visit": int(visit),
+                "processed_ccds": len(self._ccds[visit]),
+                "n_matches": counts["n_matches"],
+                "n_stack": counts["n_stack"],
+                "n_decaps": counts["n_decaps"],
+                "n_missing_from_stack": counts["n_missing_from_stack"]}
+
+
 class MakeDecapsPlots:
 
     def run(self):
         parser = argparse.ArgumentParser()
-        parser.add_argument("visit", type=int)
-        parser.add_argument("catalog", type=str)
+        parser.add_argument("catalogs", type=str, nargs="+",
+                            help="Matched visit catalogs; the visit is read from each catalog "
+                                 "unless --visit is given.")
+        parser.add_argument("--visit", type=int, default=None,
+                            help="Visit of all the catalogs, overriding their visit column. "
+                                 "Needed for catalogs with NaN visits on DECaPS-only rows.")
+        parser.add_argument("--metrics-store", type=str, default="metrics_store")
+        parser.add_argument("--run-label", type=str, default="default")
 
         args = parser.parse_args()
 
-        catalog = pd.read_parquet(args.catalog)
-        plot_funcs = [self.plot_completeness]
-        for f in plot_funcs:
-            f(catalog, args.visit)
+        histogram = CompletenessHistogram()
+        for filename in args.catalogs:
+            histogram.add_file(filename, visit=args.visit)
 
-    def plot_completeness(self, catalog, visit):
-        sel_crowdsource = catalog['decapsid'] > 0
-        sel_stack = catalog['id'] > 0
-        sel_matches =  (catalog['id'] > 0) & (catalog['decapsid'] > 0)
-        sel_missing_from_stack = (~(catalog['id'] > 0)) & (catalog['decapsid'] > 0)
-        number_ccds = len(np.unique(catalog['ccd'][catalog['ccd'] >= 0].astype(int)))
+        metrics_store = MetricsStore(args.metrics_store)
+        for visit in histogram.visits:
+            self.plot_completeness(histogram, visit, metrics_store=metrics_store,
+                                   run_label=args.run_label)
+        if(len(histogram.visits) > 1):
+            self.plot_completeness(histogram)
 
+    def plot_completeness(self, histogram, visit=None, metrics_store=None,
+                          run_label="default"):
+        """Plot the completeness of one visit, or of all visits combined if
+        visit is None, and record the visit's metrics in metrics_store."""
+        H_total, H_matches, H_nonmatches = histogram.histograms(visit)
+        bins = histogram.bins
 
-        H_total, bins = np.histogram(-2.5*np.log10(catalog['flux'][sel_crowdsource]), range=(-18, -6), bins=20)
-        H_matches, _ = np.histogram(-2.5*np.log10(catalog['flux'][sel_matches]), bins=bins)
-        H_nonmatches, _ = np.histogram(-2.5*np.log10(catalog['flux'][sel_missing_from_stack]), bins=bins)
-
+        plt.clf()
         ax = plt.gca()
 
         ax2 = plt.twinx()
         ax2.plot(bins[1:], H_total, 'k--', drawstyle="steps-pre", label="Counts")
         ax2.set_ylabel("Number of stars per bin")
 
-        ax.plot(bins[1:], H_nonmatches/H_total, '-', lw=4,
-                drawstyle="steps-pre", label="Fraction missing")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ax.plot(bins[1:], H_nonmatches/H_total, '-', lw=4,
+                    drawstyle="steps-pre", label="Fraction missing")
         ax.set_ylabel("Fraction of stars missing from pipe_crowd")
         ax.set_xlabel("Instrumental Mag")
 
         plt.legend(loc=0, frameon=False)
+        if visit is None:
+            plt.savefig("matches_all_visits.pdf")
+            return
         plt.savefig(f"matches_visit_{visit}.pdf")
 
-        metrics = {"visit": visit,
-                   "processed_ccds": number_ccds,
-                   "n_matches": np.sum(sel_matches),
-                   "n_stack": np.sum(sel_stack),
-                   "n_decaps": np.sum(sel_crowdsource),
-                   "n_missing_from_stack": np.sum(sel_missing_from_stack)}
-
-        with open(f"metrics_visit_{visit}.pkl", "wb") as f:
-            pickle.dump(metrics, f)
+        if metrics_store is not None:
+            metrics_store.append(run_label, histogram.metrics(visit))
 
 
 class MakeSummaryPlots:
 
     def run(self):
         parser = argparse.ArgumentParser()
-        parser.add_argument("metricglob", type=str)
-        parser.add_argument("--alt-metric-glob", type=str)
+        parser.add_argument("metrics_store", type=str)
+        parser.add_argument("run_label", type=str)
+        parser.add_argument("--alt-run-label", type=str, default=None)
+        parser.add_argument("--decaps-table", type=str, default="decaps.csv")
 
         args = parser.parse_args()
 
-        metrics = []
-        for filename in glob.glob(args.metricglob):
-            with open(filename, "rb") as f:
-                metric = pickle.load(f)
-                metrics.append(metric)
+        run_labels = [args.run_label]
+        if(args.alt_run_label):
+            run_labels.append(args.alt_run_label)
+        all_metrics = MetricsStore(args.metrics_store).read(run_labels)
 
-        alt_metrics = []
-        if(len(args.alt_metric_glob) > 0):
-            for filename in glob.glob(args.alt_metric_glob):
-                with open(filename, "rb") as f:
-                    metric = pickle.load(f)
-                    alt_metrics.append(metric)
+        metrics = all_metrics[all_metrics['run'] == args.run_label]
+        alt_metrics = None
+        if(args.alt_run_label):
+            alt_metrics = all_metrics[all_metrics['run'] == args.alt_run_label]
 
-        plot_funcs = [self.plot_all_visit_completeness,
-                      self.plot_all_visit_comparitive_counts]
-        for f in plot_funcs:
-            f(metrics, alt_metrics=alt_metrics)
+        decaps_table = ascii.read(args.decaps_table)
+        decaps_density = pd.DataFrame({"visit": np.asarray(decaps_table['col1'], dtype=np.int64),
+                                       "decaps_density": np.asarray(decaps_table['col6'])})
 
-    def plot_all_visit_comparitive_counts(self, metrics, alt_metrics=None):
+        self.plot_all_visit_completeness(metrics, alt_metrics=alt_metrics)
+        self.plot_all_visit_comparitive_counts(metrics, decaps_density,
+                                               alt_metrics=alt_metrics)
 
-
-        decaps_table = ascii.read("decaps.csv")
-        decaps_table_visit = decaps_table['col1']
-        decaps_table_density = decaps_table['col6']
-        decaps_density_dict = {visit: density for (visit, density) in
-                               zip(decaps_table_visit, decaps_table_density)}
+    def plot_all_visit_comparitive_counts(self, metrics, decaps_density, alt_metrics=None):
 
         plt.clf()
         ax = plt.gca()
 
-        stack_counts = np.array([x['n_stack']
-                              for x in alt_metrics])
-        n_ccds = np.array([x['processed_ccds']
-                              for x in alt_metrics])
-        area = n_ccds * 0.045 # sq degrees per sensor
-        decaps_density = np.array([decaps_density_dict[x['visit']] for x in
-                                   alt_metrics])
-        # ax.plot(stack_counts/area, decaps_counts/area, 'rx', label="stock stack")
-        ax.plot(stack_counts/area, decaps_density, 'rx', label="stock stack")
-
-        pipe_crowd_counts = np.array([x['n_stack']
-                              for x in metrics])
-        n_ccds = np.array([x['processed_ccds']
-                              for x in metrics])
-        decaps_density = np.array([decaps_density_dict[x['visit']] for x in
-                                   metrics])
-        area = n_ccds * 0.045 # sq degrees per sensor
-        ax.plot(pipe_crowd_counts/area, decaps_density, 'bo', label="pipe_crowd")
+        if(alt_metrics is not None):
+            alt_joined = alt_metrics.merge(decaps_density, on="visit")
+            area = alt_joined['processed_ccds'] * 0.045 # sq degrees per sensor
+            ax.plot(alt_joined['n_stack']/area, alt_joined['decaps_density'], 'rx',
+                    label="stock stack")
 
-        ax.plot([0, 550e3], [0, 550e3], 'k-')
+        joined = metrics.merge(decaps_density, on="visit")
+        area = joined['processed_ccds'] * 0.045 # sq degrees per sensor
+        ax.plot(joined['n_stack']/area, joined['decaps_density'], 'bo', label="pipe_crowd")
 
-        metrics_by_visit = {x['visit']: x for x in metrics}
-        alt_metrics_by_visit = {x['visit']: x for x in alt_metrics}
-        for visit in metrics_by_visit.keys():
-            original_x = (alt_metrics_by_visit[visit]['n_stack'] /
-                          (alt_metrics_by_visit[visit]['processed_ccds'] * 0.045))
-
-            original_y = (alt_metrics_by_visit[visit]['n_decaps'] /
-                          (alt_metrics_by_visit[visit]['processed_ccds'] * 0.045))
-
-            new_x = (metrics_by_visit[visit]['n_stack'] /
-                     (metrics_by_visit[visit]['processed_ccds'] * 0.045))
-
-            new_y = (metrics_by_visit[visit]['n_decaps'] /
-                     (metrics_by_visit[visit]['processed_ccds'] * 0.045))
-
-            # plt.plot([original_x, new_x], [original_y, new_y], 'k-')
-            # plt.text(new_x, new_y, "{:d}".format(visit))
+        ax.plot([0, 550e3], [0, 550e3], 'k-')
 
         ax.set_xlabel("LSST Density (per sq deg)")
         ax.set_ylabel("DECAPS Density (per sq deg)")
@@ -244,23 +772,10 @@ class MakeSummaryPlots:
         plt.clf()
         ax = plt.gca()
 
-        fractions = np.array([x['n_matches']/x['n_decaps']
-                              for x in metrics])
-        decaps_counts = np.array([x['n_decaps']
-                              for x in metrics])
+        ax.plot(metrics['n_decaps'], metrics['n_matches']/metrics['n_decaps'], 'o')
 
-        ax.plot(decaps_counts, fractions, 'o')
-
-        if(alt_metrics):
-            alt_fractions = np.array([x['n_matches']/x['n_decaps']
-                                  for x in alt_metrics])
-            alt_decaps_counts = np.array([x['n_decaps']
-                                  for x in alt_metrics])
-            ax.plot(alt_decaps_counts, alt_fractions, 'ro')
+        if(alt_metrics is not None):
+            ax.plot(alt_metrics['n_decaps'], alt_metrics['n_matches']/alt_metrics['n_decaps'], 'ro')
 
         ax.set_ylim(0, 1.1)
         plt.savefig("all_visit_completness.pdf")
-
-
-
-
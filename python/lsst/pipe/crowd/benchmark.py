@@ -0,0 +1,107 @@
+
+import argparse
+import time
+import numpy as np
+
+import lsst.afw.image as afwImage
+from lsst.geom import Point2D
+from lsst.meas.algorithms.installGaussianPsf import InstallGaussianPsfTask, InstallGaussianPsfConfig
+
+from .crowdedFieldMatrix import CrowdedFieldMatrix, CrowdedFieldMatrixD
+
+__all__ = ["BenchmarkSolverPrecision"]
+
+
+class BenchmarkSolverPrecision:
+    """Compare the single, double and mixed precision flux solves on a
+    synthetic crowded field.
+
+    Sources are placed at random with log-uniform fluxes, so that faint
+    sources sit next to bright ones, and the exposure gets Gaussian noise
+    matching its variance plane.
+    """
+
+    def makeField(self, size, n_sources, fwhm, min_flux, max_flux, sky_variance, seed):
+        rng = np.random.RandomState(seed)
+
+        exposure = afwImage.ExposureF(size, size)
+        psfConfig = InstallGaussianPsfConfig()
+        psfConfig.fwhm = fwhm
+        InstallGaussianPsfTask(config=psfConfig).run(exposure=exposure)
+
+        x = rng.uniform(0, size - 1, n_sources)
+        y = rng.uniform(0, size - 1, n_sources)
+        flux = 10**rng.uniform(np.log10(min_flux), np.log10(max_flux), n_sources)
+
+        image = exposure.getMaskedImage().getImage()
+        psf = exposure.getPsf()
+        for xx, yy, ff in zip(x, y, flux):
+            psfImg = psf.computeImage(Point2D(xx, yy))
+            psfImg *= ff
+            bbox = psfImg.getBBox()
+            bbox.clip(exposure.getBBox())
+            if bbox.isEmpty():
+                continue
+            subim = image[bbox]
+            subim += psfImg[bbox].convertF()
+
+        image_array = image.getArray()
+        variance = sky_variance + np.clip(image_array, 0, None)
+        image_array += rng.normal(size=image_array.shape)*np.sqrt(variance)
+        exposure.getMaskedImage().getVariance().getArray()[:] = variance
+
+        return exposure, x, y, flux
+
+    def runMode(self, mode, exposure, x, y):
+        matrix_class = CrowdedFieldMatrixD if mode == "double" else CrowdedFieldMatrix
+
+        start = time.perf_counter()
+        matrix = matrix_class(exposure, x, y)
+        if mode == "mixed":
+            matrix.setMixedPrecision(True)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        status = matrix.solve()
+        solve_time = time.perf_counter() - start
+
+        return dict(mode=mode, status=status == matrix.SUCCESS, iterations=matrix.iterations(),
+                    build_time=build_time, solve_time=solve_time,
+                    result=np.array(matrix.result(), dtype=np.float64))
+
+    def run(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--size", type=int, default=1000)
+        parser.add_argument("--num-sources", type=int, default=5000)
+        parser.add_argument("--fwhm", type=float, default=4.0)
+        parser.add_argument("--min-flux", type=float, default=50.0)
+        parser.add_argument("--max-flux", type=float, default=1e6)
+        parser.add_argument("--sky-variance", type=float, default=50.0)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--modes", type=str, nargs="+", default=["single", "double", "mixed"],
+                            choices=["single", "double", "mixed"])
+
+        args = parser.parse_args()
+
+        exposure, x, y, flux = self.makeField(args.size, args.num_sources, args.fwhm,
+                                              args.min_flux, args.max_flux,
+                                              args.sky_variance, args.seed)
+
+        results = [self.runMode(mode, exposure, x, y) for mode in args.modes]
+        reference = next((r["result"] for r in results if r["mode"] == "double"), None)
+
+        print(f"{args.num_sources:d} sources on {args.size:d}x{args.size:d} pixels, "
+              f"fluxes {args.min_flux:g} to {args.max_flux:g}")
+        print(f"{'mode':>8s} {'status':>8s} {'iter':>6s} {'build [s]':>10s} {'solve [s]':>10s} "
+              f"{'rms(dF/F)':>10s} {'max|F - F_double|/err':>24s}")
+        # Approximate PSF-fit flux uncertainty, to put the differences in context.
+        flux_err = np.sqrt(args.sky_variance*4*np.pi*(args.fwhm/2.355)**2 + flux)
+        for r in results:
+            rms = np.sqrt(np.mean(((r["result"] - flux)/flux)**2))
+            if reference is not None:
+                diff = np.max(np.abs(r["result"] - reference)/flux_err)
+                diff_str = f"{diff:24.3g}"
+            else:
+                diff_str = f"{'-':>24s}"
+            print(f"{r['mode']:>8s} {'ok' if r['status'] else 'FAILED':>8s} {r['iterations']:6d} "
+                  f"{r['build_time']:10.3f} {r['solve_time']:10.3f} {rms:10.3g} {diff_str}")
@@ -1,10 +1,15 @@
 
 
+import hashlib
+import json
+import os
 import numpy as np
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 import lsst.afw.table as afwTable
 import lsst.afw.image as afwImage
+import lsst.geom as geom
+from lsst.daf.base import PropertyList
 from lsst.meas.algorithms import SourceDetectionTask, SourceDetectionConfig
 from lsst.pipe.base import ArgumentParser
 import lsst.pipe.base.connectionTypes as cT
@@ -13,7 +18,7 @@ from lsst.utils.timer import timeMethod
 from scipy.spatial import cKDTree
 
 
-from .crowdedFieldMatrix import CrowdedFieldMatrix
+from .crowdedFieldMatrix import CrowdedFieldMatrix, CrowdedFieldMatrixD
 from .modelImage import ModelImageTask, ModelImageTaskConfig
 from .centroid import CrowdedCentroidTask, CrowdedCentroidTaskConfig
 
@@ -50,6 +55,11 @@ class CrowdedFieldConnections(pipeBase.PipelineTaskConnections, dimensions=("ins
         dimensions=("instrument", "visit", "detector")
     )
 
+    def __init__(self, *, config=None):
+        super().__init__(config=config)
+        if not config.doWriteModel:
+            self.outputs.remove("crowdedFieldModel")
+
 
 class CrowdedFieldTaskConfig(pipeBase.PipelineTaskConfig, pipelineConnections=CrowdedFieldConnections):
     """Config for CrowdedFieldTask"""
@@ -93,10 +103,70 @@ class CrowdedFieldTaskConfig(pipeBase.PipelineTaskConfig, pipelineConnections=Cr
         doc="Filter sources before fitting so that none have separation less than minCentroidSeparation",
     )
 
+    computeFluxErrors = pexConfig.Field(
+        dtype=bool,
+        default=True,
+        doc="Compute flux uncertainties from the final simultaneous fit?",
+    )
+
+    solverPrecision = pexConfig.ChoiceField(
+        dtype=str,
+        default="single",
+        allowed={
+            "single": "Single precision matrix and solver",
+            "double": "Double precision matrix and solver",
+            "mixed": "Single precision matrix, with the solver vectors accumulated in double",
+        },
+        doc="Floating point precision of the simultaneous flux solve",
+    )
+
+    doWriteModel = pexConfig.Field(
+        dtype=bool,
+        default=True,
+        doc="Persist the model image? It can be regenerated from the output "
+            "catalog and the calexp PSF with ModelImageTask.makeModelExposure",
+    )
+
+    doTiling = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Process the exposure in overlapping tiles to bound peak memory use?",
+    )
+
+    tileSize = pexConfig.Field(
+        dtype=int,
+        default=2048,
+        doc="Size in pixels of the tiles that own sources when doTiling is set",
+    )
+
+    tileBorder = pexConfig.Field(
+        dtype=int,
+        default=64,
+        doc="Border in pixels added around each tile when fitting, so that "
+            "sources near a tile edge are fit together with their neighbours",
+    )
+
+    checkpointDir = pexConfig.Field(
+        dtype=str,
+        default=None,
+        optional=True,
+        doc="Directory in which to write the source catalog after each detection round. "
+            "No checkpoints are written if None.",
+    )
+
+    doResume = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Resume from the last completed round in checkpointDir, if a checkpoint "
+            "matches the input exposure and config?",
+    )
+
     def validate(self):
         super().validate()
         if(self.fitSimultaneousPositions):
            raise ValueError("fitSimultaneousPositions not currently supported.")
+        if(self.tileSize <= 0 or self.tileBorder < 0):
+           raise ValueError("tileSize must be positive and tileBorder non-negative.")
 
 
 
@@ -115,6 +185,9 @@ class CrowdedFieldTask(pipeBase.PipelineTask):
         self.simultaneousPsfFlux_key = self.schema.addField(
             "crowd_psfFlux_flux_instFlux", type=np.float64,
             doc="PSF Flux from simultaneous fitting")
+        self.simultaneousPsfFluxErr_key = self.schema.addField(
+            "crowd_psfFlux_flux_instFluxErr", type=np.float64,
+            doc="PSF Flux uncertainty from simultaneous fitting")
         self.schema.getAliasMap().set("slot_PsfFlux",
                                       "crowd_psfFlux_flux")
         self.centroid_key = afwTable.Point2DKey.addFields(self.schema,
@@ -136,9 +209,283 @@ class CrowdedFieldTask(pipeBase.PipelineTask):
     @timeMethod
     def run(self, exposure):
 
+        if self.config.doTiling:
+            source_catalog = self._fitTiles(exposure)
+        else:
+            source_catalog = self._fitSources(exposure)
+
+        if source_catalog is None:
+            return None
+
+        self.log.info("Final source catalog length: %d", len(source_catalog))
+
+        # Fill-in coord_ra/coord_dec
+        afwTable.updateSourceCoords(exposure.getWcs(), sourceList=source_catalog)
+
+        # Subtract in-place
+        if self.config.doTiling:
+            model_exposure = self._subtractModelTiles(exposure, source_catalog)
+        else:
+            model_image = self.modelImageTask.run(exposure, source_catalog,
+                                                  self.simultaneousPsfFlux_key)
+            model_exposure = afwImage.ExposureF(model_image, wcs=exposure.getWcs())
+
+        return pipeBase.Struct(crowdedFieldCat=source_catalog,
+                               crowdedFieldResidual=exposure,
+                               crowdedFieldModel=model_exposure)
+
+    def _makeTileBoxes(self, bbox):
+        """Split bbox into non-overlapping tiles of at most tileSize pixels."""
+        tile_boxes = []
+        tile_extent = geom.Extent2I(self.config.tileSize, self.config.tileSize)
+        for y0 in range(bbox.getMinY(), bbox.getMaxY() + 1, self.config.tileSize):
+            for x0 in range(bbox.getMinX(), bbox.getMaxX() + 1, self.config.tileSize):
+                tile_bbox = geom.Box2I(geom.Point2I(x0, y0), tile_extent)
+                tile_bbox.clip(bbox)
+                tile_boxes.append(tile_bbox)
+        return tile_boxes
+
+    @staticmethod
+    def _depthInBox(box, x, y):
+        """Distance of (x, y) inside box; negative outside."""
+        return min(x - box.getMinX(), box.getMaxX() - x, y - box.getMinY(), box.getMaxY() - y)
+
+    def _fitTiles(self, exposure):
+        """Fit sources tile by tile and stitch the results together.
+
+        Each tile is fit on its own copy of the tile plus a border of
+        tileBorder pixels. Detection changes that copy in place, and its core
+        is written back into the exposure as soon as the tile is fit. Before
+        that, the original pixels of the parts of the core that later tiles
+        use as their border are saved, and those tiles are fit with them
+        restored, so no tile sees the changes made by another. Only these
+        border strips are kept in addition to the current tile.
+
+        A tile keeps the sources within tileBorder/2 pixels of its own area.
+        A star near a tile edge can therefore be kept by both tiles. Such
+        duplicates are found by matching the kept centroids across tiles
+        within minCentroidSeparation, and only the copy that lies deepest
+        inside its own tile is kept, so that every source is owned by exactly
+        one tile.
+        """
+        source_catalog = afwTable.SourceCatalog(self.schema)
+        source_catalog.schema.getAliasMap().set("slot_Centroid", "centroid")
+
+        margin = 0.5*self.config.tileBorder
+        candidates = []
+        tile_boxes = self._makeTileBoxes(exposure.getBBox())
+        fit_boxes = []
+        for tile_bbox in tile_boxes:
+            fit_bbox = geom.Box2I(tile_bbox)
+            fit_bbox.grow(self.config.tileBorder)
+            fit_bbox.clip(exposure.getBBox())
+            fit_boxes.append(fit_bbox)
+
+        # Original pixels of already-fit cores, keyed by the tile that needs them.
+        saved_strips = {}
+        for n, (tile_bbox, fit_bbox) in enumerate(zip(tile_boxes, fit_boxes)):
+            self.log.info("Fitting tile %d of %d: %s", n + 1, len(tile_boxes), tile_bbox)
+            tile_exposure = afwImage.ExposureF(exposure, fit_bbox, afwImage.PARENT, deep=True)
+            for strip_bbox, strip in saved_strips.pop(n, []):
+                tile_exposure.getMaskedImage().assign(strip, strip_bbox)
+
+            tile_catalog = self._fitSources(tile_exposure)
+            if tile_catalog is None:
+                return None
+
+            for later in range(n + 1, len(tile_boxes)):
+                if not tile_bbox.overlaps(fit_boxes[later]):
+                    continue
+                strip_bbox = geom.Box2I(tile_bbox)
+                strip_bbox.clip(fit_boxes[later])
+                strip = afwImage.MaskedImageF(exposure.getMaskedImage(), strip_bbox,
+                                              afwImage.PARENT, deep=True)
+                saved_strips.setdefault(later, []).append((strip_bbox, strip))
+            exposure.getMaskedImage().assign(tile_exposure.getMaskedImage()[tile_bbox], tile_bbox)
+            del tile_exposure
+
+            tile_core = geom.Box2D(tile_bbox)
+            for record in tile_catalog:
+                centroid = record.getCentroid()
+                depth = self._depthInBox(tile_core, centroid.getX(), centroid.getY())
+                if depth > -margin:
+                    candidates.append((n, depth, record))
+
+        keep = np.ones(len(candidates), dtype=bool)
+        if len(candidates) > 0:
+            positions = np.array([[record.getCentroid().getX(), record.getCentroid().getY()]
+                                  for _, _, record in candidates])
+            centroid_tree = cKDTree(positions)
+            for i, j in centroid_tree.query_pairs(self.config.minCentroidSeparation):
+                (tile_i, depth_i, _), (tile_j, depth_j, _) = candidates[i], candidates[j]
+                if tile_i == tile_j:
+                    continue
+                if depth_i >= depth_j:
+                    keep[j] = False
+                else:
+                    keep[i] = False
+            self.log.info("Removed %d sources fit by more than one tile.", np.sum(~keep))
+
+        for (_, _, record), kept in zip(candidates, keep):
+            if not kept:
+                continue
+            new_record = source_catalog.addNew()
+            new_id = new_record.getId()
+            new_record.assign(record)
+            new_record.setId(new_id)
+
+        return source_catalog
+
+    def _subtractModelTiles(self, exposure, source_catalog):
+        """Subtract the model from the exposure in place, one tile at a time.
+
+        Each tile's model is rendered only over that tile, with the same
+        pixel values as the full-frame model. The full model exposure is
+        only assembled if it is to be written.
+        """
+        model_exposure = None
+        if self.config.doWriteModel:
+            model_exposure = afwImage.ExposureF(exposure.getBBox(), exposure.getWcs())
+
+        for tile_bbox in self._makeTileBoxes(exposure.getBBox()):
+            tile_model = self.modelImageTask.makeModelExposure(source_catalog,
+                                                               self.simultaneousPsfFlux_key,
+                                                               exposure.getPsf(), tile_bbox,
+                                                               exposure=exposure)
+            residual = afwImage.MaskedImageF(exposure.getMaskedImage(), tile_bbox,
+                                             afwImage.PARENT, deep=False)
+            residual -= tile_model.getMaskedImage()
+            if model_exposure is not None:
+                model_exposure.getMaskedImage().assign(tile_model.getMaskedImage(), tile_bbox)
+
+        return model_exposure
+
+    # Config fields that do not change the result of a completed round, so
+    # changing them does not invalidate a checkpoint.
+    _checkpointIgnoredFields = ("num_iterations", "checkpointDir", "doResume",
+                                "doWriteModel", "saveMetadata", "saveLogOutput")
+
+    _checkpointNextIdKey = "CROWD_NEXT_ID"
+
+    # Config fields only used from the second detection round on, so
+    # changing them keeps the first-round checkpoint valid.
+    _checkpointLaterRoundFields = ("peak_significance_cutoff",)
+
+    def _checkpointKeys(self, exposure):
+        """Hashes of the input exposure and the config identifying the
+        checkpoints of the first and of the later detection rounds.
+
+        Detection mask planes are excluded, since earlier rounds set them on
+        the input exposure. The PSF is not included in the hash.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(str(exposure.getBBox()).encode())
+        masked_image = exposure.getMaskedImage()
+        detected_bits = masked_image.getMask().getPlaneBitMask(["DETECTED", "DETECTED_NEGATIVE"])
+        hasher.update(np.ascontiguousarray(masked_image.getImage().getArray()))
+        hasher.update(np.ascontiguousarray(masked_image.getVariance().getArray()))
+        hasher.update(np.ascontiguousarray(masked_image.getMask().getArray() & ~detected_bits))
+
+        keys = []
+        for ignored_fields in (self._checkpointIgnoredFields + self._checkpointLaterRoundFields,
+                               self._checkpointIgnoredFields):
+            config_dict = self.config.toDict()
+            for name in ignored_fields:
+                config_dict.pop(name, None)
+            round_hasher = hasher.copy()
+            round_hasher.update(json.dumps(config_dict, sort_keys=True, default=str).encode())
+            keys.append(round_hasher.hexdigest())
+        return tuple(keys)
+
+    def _checkpointFilename(self, checkpoint_keys, detection_round, suffix=""):
+        checkpoint_key = checkpoint_keys[0] if detection_round == 1 else checkpoint_keys[1]
+        return os.path.join(self.config.checkpointDir,
+                            f"{checkpoint_key}_round{detection_round:d}{suffix}.fits")
+
+    def _writeAtomic(self, write, filename):
+        tmp_filename = os.path.join(os.path.dirname(filename),
+                                    "." + os.path.basename(filename)[:-len(".fits")] + ".tmp.fits")
+        write(tmp_filename)
+        os.replace(tmp_filename, filename)
+
+    def _writeCheckpoint(self, checkpoint_keys, detection_round, source_catalog, exposure):
+        os.makedirs(self.config.checkpointDir, exist_ok=True)
+        if detection_round == 1:
+            # First-round detection subtracts a background from the input
+            # exposure and sets its detection mask planes in place; later
+            # rounds start from those pixels, so they are saved too.
+            self._writeAtomic(exposure.getMaskedImage().writeFits,
+                              self._checkpointFilename(checkpoint_keys, 1, "_exposure"))
+        filename = self._checkpointFilename(checkpoint_keys, detection_round)
+        # Record the next source id, so that a resumed run assigns the same
+        # ids as an uninterrupted one even if the last sources were deleted.
+        metadata = source_catalog.getMetadata()
+        checkpoint_metadata = PropertyList() if metadata is None else metadata.deepCopy()
+        checkpoint_metadata.set(self._checkpointNextIdKey,
+                                source_catalog.getTable().getIdFactory().clone()())
+        source_catalog.setMetadata(checkpoint_metadata)
+        try:
+            self._writeAtomic(source_catalog.writeFits, filename)
+        finally:
+            source_catalog.setMetadata(metadata)
+        self.log.info("Wrote checkpoint for detection round %d: %s", detection_round, filename)
+
+    def _readCheckpoint(self, checkpoint_keys, exposure):
+        """Return (round, catalog) for the last completed round that can be
+        resumed from, or None.
+
+        The exposure is restored to its state after first-round detection.
+        """
+        exposure_filename = self._checkpointFilename(checkpoint_keys, 1, "_exposure")
+        if not os.path.exists(exposure_filename):
+            return None
+
+        for detection_round in range(self.config.num_iterations, 0, -1):
+            filename = self._checkpointFilename(checkpoint_keys, detection_round)
+            if os.path.exists(filename):
+                break
+        else:
+            return None
+
+        self.log.info("Resuming after detection round %d from %s", detection_round, filename)
+        exposure.getMaskedImage().assign(afwImage.MaskedImageF(exposure_filename))
+        source_catalog = afwTable.SourceCatalog.readFits(filename)
+        # The table read back has a fresh IdFactory; move it to where the
+        # checkpointed run left it so later rounds do not reuse any ids.
+        metadata = source_catalog.getMetadata()
+        if metadata is not None and metadata.exists(self._checkpointNextIdKey):
+            source_catalog.getTable().getIdFactory().notify(
+                metadata.getScalar(self._checkpointNextIdKey) - 1)
+            metadata.remove(self._checkpointNextIdKey)
+        elif len(source_catalog) > 0:
+            source_catalog.getTable().getIdFactory().notify(int(np.max(source_catalog["id"])))
+        return detection_round, source_catalog
+
+    def _makeSolverMatrix(self, exposure, source_catalog):
+        if self.config.solverPrecision == "double":
+            solver_matrix = CrowdedFieldMatrixD(exposure, source_catalog,
+                                                self.simultaneousPsfFlux_key)
+        else:
+            solver_matrix = CrowdedFieldMatrix(exposure, source_catalog,
+                                               self.simultaneousPsfFlux_key)
+            solver_matrix.setMixedPrecision(self.config.solverPrecision == "mixed")
+        return solver_matrix
+
+    def _fitSources(self, exposure):
+
         source_catalog = afwTable.SourceCatalog(self.schema)
+        first_round = 1
 
-        for detection_round in range(1, self.config.num_iterations + 1):
+        checkpoint_keys = None
+        if self.config.checkpointDir is not None:
+            checkpoint_keys = self._checkpointKeys(exposure)
+            if self.config.doResume:
+                checkpoint = self._readCheckpoint(checkpoint_keys, exposure)
+                if checkpoint is not None:
+                    completed_round, source_catalog = checkpoint
+                    first_round = completed_round + 1
+
+        for detection_round in range(first_round, self.config.num_iterations + 1):
 
             detection_catalog = afwTable.SourceCatalog(self.schema)
             if(len(source_catalog) > 0):
@@ -182,8 +529,7 @@ class CrowdedFieldTask(pipeBase.PipelineTask):
             self.log.info("Source catalog length after detection round %d: %d",
                           detection_round, len(source_catalog))
 
-            solver_matrix = CrowdedFieldMatrix(exposure, source_catalog,
-                                               self.simultaneousPsfFlux_key)
+            solver_matrix = self._makeSolverMatrix(exposure, source_catalog)
 
             status = solver_matrix.solve()
             if(status != solver_matrix.SUCCESS):
@@ -232,9 +578,14 @@ class CrowdedFieldTask(pipeBase.PipelineTask):
                 if(len(remaining_pairs) > 0):
                     self.log.warn("Close-pairs remain after filtering: " +  ", ".join(f"{x:d}" for x in remaining_pairs))
 
-            # Now that we have more precise centroids, re-fit the fluxes
-            solver_matrix = CrowdedFieldMatrix(exposure, source_catalog,
-                                               self.simultaneousPsfFlux_key)
+            # Now that we have more precise centroids, re-fit the fluxes.
+            # This reuses the matrix structure from solve 1 if the sources
+            # still cover the same pixels. Flux errors are only needed from
+            # the final fit, so they are not computed on earlier rounds.
+            if self.config.computeFluxErrors and detection_round == self.config.num_iterations:
+                solver_matrix.setFluxErrKey(self.simultaneousPsfFluxErr_key)
+            if solver_matrix.updateCatalog(source_catalog):
+                self.log.debug("Reusing matrix structure for iteration %d solve 2", detection_round)
 
             status = solver_matrix.solve()
             if(status != solver_matrix.SUCCESS):
@@ -242,19 +593,7 @@ class CrowdedFieldTask(pipeBase.PipelineTask):
                 raise RuntimeError(f"Matrix solution failed on iteration {detection_round} solve 2")
                 return None
 
-        self.log.info("Final source catalog length: %d", len(source_catalog))
-
-        # Fill-in coord_ra/coord_dec
-        afwTable.updateSourceCoords(exposure.getWcs(), sourceList=source_catalog)
-
-        # Subtract in-place
-        model_image = self.modelImageTask.run(exposure, source_catalog,
-                                              self.simultaneousPsfFlux_key)
-
-        model_exposure = afwImage.ExposureF(model_image, wcs=exposure.getWcs())
-
-        return pipeBase.Struct(crowdedFieldCat=source_catalog,
-                               crowdedFieldResidual=exposure,
-                               crowdedFieldModel=model_exposure)
-
+            if checkpoint_keys is not None:
+                self._writeCheckpoint(checkpoint_keys, detection_round, source_catalog, exposure)
 
+        return source_catalog
@@ -1,5 +1,6 @@
 
 #include <Eigen/Sparse>
+#include <string>
 #include <vector>
 
 #include "pybind11/pybind11.h"
@@ -18,42 +19,90 @@ namespace lsst {
 namespace pipe {
 namespace crowd {
 
-PYBIND11_MODULE(crowdedFieldMatrix, mod) {
+namespace {
+
+template <typename PixelT, typename MatrixT>
+py::class_<CrowdedFieldMatrix<PixelT, MatrixT>, std::shared_ptr<CrowdedFieldMatrix<PixelT, MatrixT>>>
+declareCrowdedFieldMatrix(py::module &mod, std::string const &name) {
+
+    using Class = CrowdedFieldMatrix<PixelT, MatrixT>;
 
-    py::class_<CrowdedFieldMatrix<float>, std::shared_ptr<CrowdedFieldMatrix<float>>>
-            clsCrowdedFieldMatrix(mod, "CrowdedFieldMatrix");
+    py::class_<Class, std::shared_ptr<Class>> clsCrowdedFieldMatrix(mod, name.c_str());
 
-    clsCrowdedFieldMatrix.def(py::init<const afw::image::Exposure<float> &,
+    clsCrowdedFieldMatrix.def(py::init<const afw::image::Exposure<PixelT> &,
                                        ndarray::Array<double const, 1> &,
                                         ndarray::Array<double const, 1> &>(),
                               "exposure"_a, "x"_a, "y"_a);
 
-    clsCrowdedFieldMatrix.def(py::init<const afw::image::Exposure<float> &,
+    clsCrowdedFieldMatrix.def(py::init<const std::vector<afw::image::Exposure<PixelT>> &,
+                                       ndarray::Array<double const, 1> &,
+                                       ndarray::Array<double const, 1> &,
+                                       bool>(),
+                              "exposures"_a, "x"_a, "y"_a, "sharedFlux"_a=false);
+
+    clsCrowdedFieldMatrix.def(py::init<const afw::image::Exposure<PixelT> &,
                                        afw::table::SourceCatalog *,
                                        afw::table::Key<double>,
                                        bool,
-                                       afw::table::PointKey<double>>(),
+                                       afw::table::PointKey<double>,
+                                       afw::table::Key<double>>(),
                               "exposure"_a, "sourceCatalog"_a, "fluxKey"_a, "fitCentroids"_a=false,
-                              "centroidKey"_a=afw::table::PointKey<double>());
+                              "centroidKey"_a=afw::table::PointKey<double>(),
+                              "fluxErrKey"_a=afw::table::Key<double>());
+
+    clsCrowdedFieldMatrix.def(py::init<const std::vector<afw::image::Exposure<PixelT>> &,
+                                       afw::table::SourceCatalog *,
+                                       afw::table::Key<double>,
+                                       bool,
+                                       afw::table::PointKey<double>,
+                                       afw::table::Key<double>,
+                                       bool>(),
+                              "exposures"_a, "sourceCatalog"_a, "fluxKey"_a, "fitCentroids"_a=false,
+                              "centroidKey"_a=afw::table::PointKey<double>(),
+                              "fluxErrKey"_a=afw::table::Key<double>(),
+                              "sharedFlux"_a=false);
 
-    clsCrowdedFieldMatrix.def("_addSource", &CrowdedFieldMatrix<float>::_addSource);
+    clsCrowdedFieldMatrix.def("_addSource", &Class::_addSource);
 
-    clsCrowdedFieldMatrix.def("solve", &CrowdedFieldMatrix<float>::solve);
-    clsCrowdedFieldMatrix.def("result", &CrowdedFieldMatrix<float>::result);
+    clsCrowdedFieldMatrix.def("solve", &Class::solve);
+    clsCrowdedFieldMatrix.def("updateCatalog", &Class::updateCatalog, "sourceCatalog"_a);
+    clsCrowdedFieldMatrix.def("setMixedPrecision", &Class::setMixedPrecision, "mixedPrecision"_a);
+    clsCrowdedFieldMatrix.def("iterations", &Class::iterations);
+    clsCrowdedFieldMatrix.def("setFluxErrKey", &Class::setFluxErrKey, "fluxErrKey"_a);
+    clsCrowdedFieldMatrix.def("result", &Class::result);
+    clsCrowdedFieldMatrix.def("computeFluxVariance", &Class::computeFluxVariance,
+                              "epoch"_a=0);
+    clsCrowdedFieldMatrix.def("getFluxes", &Class::getFluxes, "epoch"_a=0);
+    clsCrowdedFieldMatrix.def("nEpochs", &Class::nEpochs);
 
-    clsCrowdedFieldMatrix.def("getMatrixEntries", &CrowdedFieldMatrix<float>::getMatrixEntries);
-    clsCrowdedFieldMatrix.def("getDataVector", &CrowdedFieldMatrix<float>::getDataVector);
+    clsCrowdedFieldMatrix.def("getMatrixEntries", &Class::getMatrixEntries);
+    clsCrowdedFieldMatrix.def("getDataVector", &Class::getDataVector);
 
 
+    // debugging
+    clsCrowdedFieldMatrix.def("_getParameterMapping", &Class::getParameterMapping);
+    clsCrowdedFieldMatrix.def("_getPixelMapping", &Class::getPixelMapping, "epoch"_a=0);
+
+    return clsCrowdedFieldMatrix;
+}
+
+} // namespace
+
+PYBIND11_MODULE(crowdedFieldMatrix, mod) {
+
+    auto clsCrowdedFieldMatrix = declareCrowdedFieldMatrix<float, float>(mod, "CrowdedFieldMatrix");
+    auto clsCrowdedFieldMatrixD = declareCrowdedFieldMatrix<float, double>(mod, "CrowdedFieldMatrixD");
+
     py::enum_<SolverStatus>(clsCrowdedFieldMatrix, "SolverStatus")
         .value("SUCCESS", SolverStatus::SUCCESS)
         .value("FAILURE", SolverStatus::FAILURE)
         .export_values();
 
-
-    // debugging
-    clsCrowdedFieldMatrix.def("_getParameterMapping", &CrowdedFieldMatrix<float>::getParameterMapping);
-    clsCrowdedFieldMatrix.def("_getPixelMapping", &CrowdedFieldMatrix<float>::getPixelMapping);
+    // The enum can only be registered once; share it with the double
+    // precision class so matrix.SUCCESS works for either.
+    for(auto attr : {"SolverStatus", "SUCCESS", "FAILURE"}) {
+        clsCrowdedFieldMatrixD.attr(attr) = clsCrowdedFieldMatrix.attr(attr);
+    }
 }
 }
 }
@@ -0,0 +1,168 @@
+
+import numpy as np
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+import lsst.afw.table as afwTable
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+import lsst.pipe.base.connectionTypes as cT
+from lsst.utils.timer import timeMethod
+
+from .crowdedFieldMatrix import CrowdedFieldMatrix
+from .modelImage import ModelImageTask
+
+
+class CrowdedFieldForcedConnections(pipeBase.PipelineTaskConnections,
+                                    dimensions=("instrument", "visit", "detector", "skymap", "tract"),
+                                    defaultTemplates={"refCatName": "deepCoadd_ref"}):
+
+    calexp = cT.Input(
+        doc="Input image to measure.",
+        name="calexp",
+        storageClass="ExposureF",
+        dimensions=("instrument", "visit", "detector"),
+    )
+
+    refCat = cT.Input(
+        doc="Reference catalog providing the sky positions of the sources.",
+        name="{refCatName}",
+        storageClass="SourceCatalog",
+        dimensions=("skymap", "tract", "patch"),
+        multiple=True,
+        deferLoad=True,
+    )
+
+    crowdedFieldCat = cT.Output(
+        doc="Output catalog from simultaneous forced fitting.",
+        name="pipeCrowd_forced_src",
+        storageClass="SourceCatalog",
+        dimensions=("instrument", "visit", "detector", "skymap", "tract")
+    )
+
+    crowdedFieldModel = cT.Output(
+        doc="Model image from sources measured in simultaneous forced fitting.",
+        name="pipeCrowd_forced_model",
+        storageClass="ExposureF",
+        dimensions=("instrument", "visit", "detector", "skymap", "tract")
+    )
+
+    crowdedFieldResidual = cT.Output(
+        doc="Residual image after subtracting sources.",
+        name="pipeCrowd_forced_residual",
+        storageClass="ExposureF",
+        dimensions=("instrument", "visit", "detector", "skymap", "tract")
+    )
+
+
+class CrowdedFieldForcedTaskConfig(pipeBase.PipelineTaskConfig,
+                                   pipelineConnections=CrowdedFieldForcedConnections):
+    """Config for CrowdedFieldForcedTask"""
+
+    modelImageTask = pexConfig.ConfigurableField(
+            target=ModelImageTask,
+            doc="Task for manipulating model images"
+    )
+
+    computeFluxErrors = pexConfig.Field(
+        dtype=bool,
+        default=True,
+        doc="Compute flux uncertainties from the simultaneous fit?",
+    )
+
+
+class CrowdedFieldForcedTask(pipeBase.PipelineTask):
+    """Fit fluxes at fixed positions taken from a reference catalog.
+
+    This skips detection and centroiding entirely; the reference sky
+    coordinates are transformed to pixels with the exposure WCS and a single
+    `CrowdedFieldMatrix` flux solve is run.
+    """
+    ConfigClass = CrowdedFieldForcedTaskConfig
+    _DefaultName = "crowdedFieldForcedTask"
+
+    def __init__(self, **kwargs):
+        pipeBase.PipelineTask.__init__(self, **kwargs)
+        self.schema = afwTable.SourceTable.makeMinimalSchema()
+        self.objectId_key = self.schema.addField(
+            "objectId", type=np.int64,
+            doc="Id of the source in the reference catalog")
+        self.simultaneousPsfFlux_key = self.schema.addField(
+            "crowd_psfFlux_flux_instFlux", type=np.float64,
+            doc="PSF Flux from simultaneous fitting")
+        self.simultaneousPsfFluxErr_key = self.schema.addField(
+            "crowd_psfFlux_flux_instFluxErr", type=np.float64,
+            doc="PSF Flux uncertainty from simultaneous fitting")
+        self.schema.getAliasMap().set("slot_PsfFlux",
+                                      "crowd_psfFlux_flux")
+        self.centroid_key = afwTable.Point2DKey.addFields(self.schema,
+                                                          "centroid",
+                                                          "Reference position", "pixels")
+        self.schema.getAliasMap().set("slot_Centroid",
+                                      "centroid")
+
+        self.makeSubtask("modelImageTask")
+
+    def runQuantum(self, butlerQC, inputRefs, outputRefs):
+        inputs = butlerQC.get(inputRefs)
+        refCat = self._concatenateRefCats([handle.get() for handle in inputs['refCat']])
+        outputs = self.run(inputs['calexp'], refCat)
+        butlerQC.put(outputs, outputRefs)
+
+    def _concatenateRefCats(self, refCats):
+        """Concatenate the per-patch reference catalogs.
+
+        The records are deep-copied so that the result is contiguous and
+        its columns (e.g. detect_isPrimary) can be read as arrays.
+        """
+        refCat = afwTable.SourceCatalog(refCats[0].schema)
+        for cat in refCats:
+            refCat.extend(cat, deep=True)
+        return refCat
+
+    @timeMethod
+    def run(self, exposure, refCat):
+
+        wcs = exposure.getWcs()
+        bbox = geom.Box2D(exposure.getBBox())
+        pixels = wcs.skyToPixel([ref.getCoord() for ref in refCat])
+
+        # Reference catalogs from overlapping patches repeat sources; keep
+        # only one copy of each so the solve is not degenerate.
+        if "detect_isPrimary" in refCat.schema.getNames():
+            isPrimary = refCat["detect_isPrimary"]
+        else:
+            isPrimary = np.ones(len(refCat), dtype=bool)
+
+        source_catalog = afwTable.SourceCatalog(self.schema)
+        for ref, pixel, primary in zip(refCat, pixels, isPrimary):
+            if not primary or not bbox.contains(pixel):
+                continue
+            child = source_catalog.addNew()
+            child.set(self.objectId_key, ref.getId())
+            child.setCoord(ref.getCoord())
+            child.set(self.centroid_key, pixel)
+
+        self.log.info("Forced source catalog length: %d", len(source_catalog))
+
+        if self.config.computeFluxErrors:
+            fluxErr_key = self.simultaneousPsfFluxErr_key
+        else:
+            fluxErr_key = afwTable.Key["D"]()
+        solver_matrix = CrowdedFieldMatrix(exposure, source_catalog,
+                                           self.simultaneousPsfFlux_key,
+                                           fluxErrKey=fluxErr_key)
+
+        status = solver_matrix.solve()
+        if(status != solver_matrix.SUCCESS):
+            self.log.error("Matrix solution failed on forced solve")
+            raise RuntimeError("Matrix solution failed on forced solve")
+
+        # Subtract in-place
+        model_image = self.modelImageTask.run(exposure, source_catalog,
+                                              self.simultaneousPsfFlux_key)
+
+        model_exposure = afwImage.ExposureF(model_image, wcs=exposure.getWcs())
+
+        return pipeBase.Struct(crowdedFieldCat=source_catalog,
+                               crowdedFieldResidual=exposure,
+                               crowdedFieldModel=model_exposure)
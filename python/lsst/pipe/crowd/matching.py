@@ -0,0 +1,78 @@
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+__all__ = ["matchPositions", "selectUniqueMatches"]
+
+
+def matchPositions(positions1, positions2, max_distance):
+    """Match two sets of positions one-to-one by nearest neighbour.
+
+    Each entry of ``positions1`` is matched to its nearest neighbour in
+    ``positions2`` within ``max_distance``. When several entries share the
+    same nearest neighbour only the closest one keeps the match; the others
+    are left unmatched rather than moved to their next-nearest neighbour.
+
+    Parameters
+    ----------
+    positions1 : `numpy.ndarray`, (N, D)
+        Positions to match.
+    positions2 : `numpy.ndarray`, (M, D)
+        Positions to match against.
+    max_distance : `float`
+        Maximum separation for a match.
+
+    Returns
+    -------
+    idx1 : `numpy.ndarray` of `int`
+        Indices into ``positions1`` of the matched entries, sorted.
+    idx2 : `numpy.ndarray` of `int`
+        Indices into ``positions2`` of the corresponding matches.
+    distance : `numpy.ndarray` of `float`
+        Separation of each match.
+    """
+    positions1 = np.asarray(positions1, dtype=np.float64)
+    positions2 = np.asarray(positions2, dtype=np.float64)
+
+    if len(positions1) == 0 or len(positions2) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.float64))
+
+    tree = cKDTree(positions2)
+    distance, idx2 = tree.query(positions1, k=1, distance_upper_bound=max_distance)
+
+    # Unmatched entries have infinite distance and idx2 == len(positions2).
+    idx1 = np.flatnonzero(np.isfinite(distance))
+    return selectUniqueMatches(idx1, idx2[idx1], distance[idx1])
+
+
+def selectUniqueMatches(idx1, idx2, distance):
+    """Reduce candidate matches to one-to-one matches.
+
+    Each ``idx1`` entry must appear at most once. For each ``idx2`` entry
+    claimed by several candidates only the closest candidate is kept.
+
+    Parameters
+    ----------
+    idx1, idx2 : `numpy.ndarray` of `int`
+        Indices of the candidate matches.
+    distance : `numpy.ndarray` of `float`
+        Separation of each candidate match.
+
+    Returns
+    -------
+    idx1, idx2, distance : `numpy.ndarray`
+        The selected matches, sorted by ``idx1``.
+    """
+    idx1 = np.asarray(idx1)
+    idx2 = np.asarray(idx2)
+    distance = np.asarray(distance)
+
+    order = np.lexsort((distance, idx2))
+    idx1, idx2, distance = idx1[order], idx2[order], distance[order]
+    first = np.ones(len(idx2), dtype=bool)
+    first[1:] = idx2[1:] != idx2[:-1]
+    idx1, idx2, distance = idx1[first], idx2[first], distance[first]
+
+    order = np.argsort(idx1)
+    return idx1[order], idx2[order].astype(np.int64), distance[order]
@@ -4,6 +4,7 @@ import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 import lsst.afw.table as afwTable
 import lsst.afw.image as afwImage
+import lsst.geom as geom
 from lsst.utils.timer import timeMethod
 
 from contextlib import contextmanager
@@ -26,19 +27,65 @@ class ModelImageTask(pipeBase.Task):
         model_arr = model_image.image.getArray()
         model_arr[:] = 0.0
 
+        self._addSources(model_image.getImage(), catalog, catalog_key,
+                         exposure.getPsf())
+
+        original_image = exposure.getMaskedImage()
+        original_image -= model_image
+        return model_image
+
+    def _addSources(self, image, catalog, catalog_key, psf):
+        """Add the PSF model of each source in catalog to image.
+
+        Sources are added in catalog order and clipped to the image bbox,
+        so any sub-region is rendered with exactly the same pixel values
+        as the full image. Sources whose centroid is further than the PSF
+        half-width outside the image cannot overlap it and are skipped
+        before their PSF image is computed.
+        """
+        psf_bbox = psf.computeBBox(psf.getAveragePosition())
+        half_width = 0.5*max(psf_bbox.getWidth(), psf_bbox.getHeight()) + 1
+        reach_bbox = geom.Box2D(image.getBBox())
+        reach_bbox.grow(half_width)
+
         for source in catalog:
             centroid = source.getCentroid()
-            psf_image = exposure.getPsf().computeImage(centroid)
+            if not reach_bbox.contains(centroid):
+                continue
+            psf_image = psf.computeImage(centroid)
             psf_image *= source[catalog_key]
             bbox = psf_image.getBBox()
-            bbox.clip(model_image.getBBox())
-            image_subregion = afwImage.ImageF(model_image.getImage(),
-                                    bbox, afwImage.LOCAL)
+            bbox.clip(image.getBBox())
+            if bbox.isEmpty():
+                continue
+            image_subregion = afwImage.ImageF(image, bbox, afwImage.PARENT)
             image_subregion += psf_image[bbox].convertF()
 
-        original_image = exposure.getMaskedImage()
-        original_image -= model_image
-        return model_image
+    @timeMethod
+    def makeModelExposure(self, catalog, catalog_key, psf, bbox, wcs=None,
+                          exposure=None):
+        """Regenerate a model exposure from a catalog of fluxes and a PSF.
+
+        The image plane is bit-identical to the model written by
+        `CrowdedFieldTask` over the same pixels, so the model only needs to
+        be persisted as a catalog. ``bbox`` may be a sub-region of the
+        original exposure. If ``exposure`` is given its mask and variance
+        are copied into the model, otherwise they are left empty.
+
+        The mask and variance planes do not in general match the persisted
+        model: that one carries the mask after detection, with the DETECTED
+        planes set, which the input calexp lacks; and the variance of the
+        residual exposure is twice that of the calexp, since the model was
+        subtracted from it as a masked image.
+        """
+        model_image = afwImage.MaskedImageF(bbox)
+        if exposure is not None:
+            model_image.getMask().assign(exposure.getMaskedImage().getMask()[bbox])
+            model_image.getVariance().assign(exposure.getMaskedImage().getVariance()[bbox])
+
+        self._addSources(model_image.getImage(), catalog, catalog_key, psf)
+
+        return afwImage.ExposureF(model_image, wcs=wcs)
 
     @timeMethod
     def makeModelSubtractedImage(self, exposure, catalog, catalog_key):
@@ -53,7 +100,7 @@ class ModelImageTask(pipeBase.Task):
             bbox = psf_image.getBBox()
             bbox.clip(subtracted_image.getBBox())
             image_subregion = afwImage.ImageF(subtracted_image.getImage(),
-                                    bbox, afwImage.LOCAL)
+                                    bbox, afwImage.PARENT)
             image_subregion -= psf_image[bbox].convertF()
 
         return subtracted_image
@@ -72,7 +119,7 @@ class ModelImageTask(pipeBase.Task):
         bbox.clip(subtracted_image.getBBox())
 
         image_subregion = afwImage.ImageF(subtracted_image.getImage(),
-                                          bbox, afwImage.LOCAL)
+                                          bbox, afwImage.PARENT)
         image_subregion += psf_image[bbox].convertF()
 
         try:
@@ -9,11 +9,16 @@
 #include "lsst/afw/detection/Psf.h"
 #include "lsst/geom/Point.h"
 #include "lsst/afw/image/Mask.h"
+#include "lsst/afw/geom/SkyWcs.h"
 
 #include "lsst/pipe/crowd/CrowdedFieldMatrix.h"
 
 #include "Eigen/SparseCore"
 #include "Eigen/IterativeLinearSolvers"
+#include "Eigen/Dense"
+
+#include <algorithm>
+#include <limits>
 
 using namespace lsst;
 
@@ -24,83 +29,197 @@ namespace crowd {
 
 LOG_LOGGER _log = LOG_GET("lsst.pipe.crowd.CrowdedFieldMatrix");
 
-template <typename PixelT>
-CrowdedFieldMatrix<PixelT>::CrowdedFieldMatrix(const afw::image::Exposure<PixelT> &exposure,
+template <typename PixelT, typename MatrixT>
+CrowdedFieldMatrix<PixelT, MatrixT>::CrowdedFieldMatrix(const afw::image::Exposure<PixelT> &exposure,
                                                ndarray::Array<double const, 1> &x,
                                                ndarray::Array<double const, 1> &y) :
-            _exposure(exposure),
+            CrowdedFieldMatrix(std::vector<afw::image::Exposure<PixelT>>{exposure}, x, y)
+{
+};
+
+template <typename PixelT, typename MatrixT>
+CrowdedFieldMatrix<PixelT, MatrixT>::CrowdedFieldMatrix(const std::vector<afw::image::Exposure<PixelT>> &exposures,
+                                               ndarray::Array<double const, 1> &x,
+                                               ndarray::Array<double const, 1> &y,
+                                               bool sharedFlux) :
+            _exposures(exposures),
             _catalog(NULL),
             _fitCentroids(false),
+            _sharedFlux(sharedFlux),
+            _nFluxParameters(sharedFlux ? 1 : exposures.size()),
             _centroidKey(afw::table::PointKey<double>()),
-            _paramTracker(ParameterTracker(1)),
+            _paramTracker(ParameterTracker(_nFluxParameters)),
             _iterations(0),
-            _maxIterations(500)
+            _maxIterations(500),
+            _matrixIsBuilt(false),
+            _useWarmStart(false),
+            _mixedPrecision(false)
 {
-    _matrixEntries = _makeMatrixEntries(exposure, x, y);
+    _matrixEntries = _makeMatrixEntries(exposures, x, y);
     _dataVector = makeDataVector();
 };
 
-template <typename PixelT>
-CrowdedFieldMatrix<PixelT>::CrowdedFieldMatrix(const afw::image::Exposure<PixelT> &exposure,
+template <typename PixelT, typename MatrixT>
+CrowdedFieldMatrix<PixelT, MatrixT>::CrowdedFieldMatrix(const afw::image::Exposure<PixelT> &exposure,
                                                afw::table::SourceCatalog *catalog,
                                                afw::table::Key<double> fluxKey,
                                                bool fitCentroids,
-                                               afw::table::PointKey<double> centroidKey) :
-            _exposure(exposure),
+                                               afw::table::PointKey<double> centroidKey,
+                                               afw::table::Key<double> fluxErrKey) :
+            CrowdedFieldMatrix(std::vector<afw::image::Exposure<PixelT>>{exposure}, catalog, fluxKey,
+                               fitCentroids, centroidKey, fluxErrKey)
+{
+};
+
+template <typename PixelT, typename MatrixT>
+CrowdedFieldMatrix<PixelT, MatrixT>::CrowdedFieldMatrix(const std::vector<afw::image::Exposure<PixelT>> &exposures,
+                                               afw::table::SourceCatalog *catalog,
+                                               afw::table::Key<double> fluxKey,
+                                               bool fitCentroids,
+                                               afw::table::PointKey<double> centroidKey,
+                                               afw::table::Key<double> fluxErrKey,
+                                               bool sharedFlux) :
+            _exposures(exposures),
             _catalog(catalog),
             _fluxKey(fluxKey),
             _fitCentroids(fitCentroids),
+            _sharedFlux(sharedFlux),
+            _nFluxParameters(sharedFlux ? 1 : exposures.size()),
             _centroidKey(centroidKey),
-            _paramTracker(ParameterTracker(fitCentroids ? 3 : 1)),
+            _fluxErrKey(fluxErrKey),
+            _paramTracker(ParameterTracker(_nFluxParameters + (fitCentroids ? 2 : 0))),
             _iterations(0),
-            _maxIterations(500)
+            _maxIterations(500),
+            _matrixIsBuilt(false),
+            _useWarmStart(false),
+            _mixedPrecision(false)
 {
-    _matrixEntries = _makeMatrixEntries(exposure, catalog);
+    _matrixEntries = _makeMatrixEntries(exposures, catalog);
     _dataVector = makeDataVector();
 };
 
 
-template <typename PixelT>
-std::vector<Eigen::Triplet<PixelT>> CrowdedFieldMatrix<PixelT>::_makeMatrixEntries(const afw::image::Exposure<PixelT> &exposure,
+template <typename PixelT, typename MatrixT>
+void CrowdedFieldMatrix<PixelT, MatrixT>::_checkExposures(
+                                               const std::vector<afw::image::Exposure<PixelT>> &exposures) {
+    if(exposures.empty()) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError, "At least one exposure is required.");
+    }
+    // Every epoch is evaluated at the same pixel positions, so the exposures
+    // must share one pixel grid; warp overlapping visits to a common one first.
+    auto wcs = exposures[0].getWcs();
+    for(size_t epoch = 1; epoch < exposures.size(); ++epoch) {
+        if(exposures[epoch].getBBox() != exposures[0].getBBox()) {
+            throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                              "All exposures must have the same bounding box.");
+        }
+        auto epochWcs = exposures[epoch].getWcs();
+        if(static_cast<bool>(wcs) != static_cast<bool>(epochWcs) || (wcs && !(*wcs == *epochWcs))) {
+            throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                              "All exposures must have the same WCS.");
+        }
+    }
+}
+
+template <typename PixelT, typename MatrixT>
+std::vector<Eigen::Triplet<MatrixT>> CrowdedFieldMatrix<PixelT, MatrixT>::_makeMatrixEntries(
+                                               const std::vector<afw::image::Exposure<PixelT>> &exposures,
                                                ndarray::Array<double const, 1> &x,
                                                ndarray::Array<double const, 1> &y) {
 
-    std::vector<Eigen::Triplet<PixelT>> matrixEntries;
+    std::vector<Eigen::Triplet<MatrixT>> matrixEntries;
 
     if(x.getSize<0>() != y.getSize<0>()) {
         throw LSST_EXCEPT(lsst::pex::exceptions::LengthError, "x and y must be the same length.");
     }
+    _checkExposures(exposures);
 
     for(size_t n = 0; n < x.getSize<0>(); ++n) {
-        _addSource(exposure, matrixEntries, n, x[n], y[n]);
+        for(size_t epoch = 0; epoch < exposures.size(); ++epoch) {
+            _addSource(exposures[epoch], matrixEntries, n, x[n], y[n], MatrixT(), epoch);
+        }
     }
     return matrixEntries;
 }
 
-template <typename PixelT>
-std::vector<Eigen::Triplet<PixelT>> CrowdedFieldMatrix<PixelT>::_makeMatrixEntries(const afw::image::Exposure<PixelT> &exposure,
+template <typename PixelT, typename MatrixT>
+std::vector<Eigen::Triplet<MatrixT>> CrowdedFieldMatrix<PixelT, MatrixT>::_makeMatrixEntries(
+                                            const std::vector<afw::image::Exposure<PixelT>> &exposures,
                                             afw::table::SourceCatalog *catalog) {
     if(catalog == NULL) {
         throw LSST_EXCEPT(lsst::pex::exceptions::RuntimeError, "sourceCatalog is NULL");
     }
-    std::vector<Eigen::Triplet<PixelT>> matrixEntries;
+    _checkExposures(exposures);
+    std::vector<Eigen::Triplet<MatrixT>> matrixEntries;
     geom::Point2D centroid;
     size_t n = 0;
     for(auto rec = catalog->begin(); rec < catalog->end(); ++rec, ++n) {
-        PixelT estFlux = PixelT();
+        MatrixT estFlux = MatrixT();
         centroid = rec->getCentroid();
         if(_fitCentroids) {
             estFlux = rec->getPsfInstFlux();
         }
-        _addSource(exposure, matrixEntries, n, centroid[0], centroid[1], estFlux);
+        for(size_t epoch = 0; epoch < exposures.size(); ++epoch) {
+            // The catalog flux is that of the first epoch; with per-epoch
+            // fluxes, the position derivatives of the other epochs use
+            // their own flux estimate.
+            MatrixT epochFlux = estFlux;
+            if(_fitCentroids && !_sharedFlux && epoch > 0) {
+                epochFlux = _estimatePsfFlux(exposures[epoch], centroid[0], centroid[1]);
+            }
+            _addSource(exposures[epoch], matrixEntries, n, centroid[0], centroid[1], epochFlux, epoch);
+        }
     }
     return matrixEntries;
 }
 
-template <typename PixelT>
-void CrowdedFieldMatrix<PixelT>::_addSource(const afw::image::Exposure<PixelT> &exposure,
-                                            std::vector<Eigen::Triplet<PixelT>> &matrixEntries,
-                                            int nStar, double x, double y, PixelT estFlux) {
+// Single-source PSF flux of one exposure at (x, y), used as the flux
+// estimate for the position derivatives.
+template <typename PixelT, typename MatrixT>
+MatrixT CrowdedFieldMatrix<PixelT, MatrixT>::_estimatePsfFlux(const afw::image::Exposure<PixelT> &exposure,
+                                                              double x, double y) {
+    using afw::image::Mask;
+    using afw::image::MaskPixel;
+    MaskPixel maskFlagsForRejection = Mask<MaskPixel>::getPlaneBitMask({"SAT", "BAD", "EDGE", "CR", "INTRP"});
+
+    auto psfImage = exposure.getPsf()->computeImage(geom::Point2D(x, y));
+    geom::Box2I clippedBBox = psfImage->getBBox();
+    clippedBBox.clip(exposure.getMaskedImage().getBBox());
+
+    auto maskedImage = exposure.getMaskedImage();
+    double weightedSum = 0.0;
+    double psfNorm = 0.0;
+    for (int j = 0; j != clippedBBox.getHeight(); ++j) {
+        for (int i = 0; i != clippedBBox.getWidth(); ++i) {
+            geom::Point2I position(clippedBBox.getMinX() + i, clippedBBox.getMinY() + j);
+            if((maskedImage.getMask()->get(position, afw::image::PARENT) & maskFlagsForRejection) > 0) {
+                continue;
+            }
+            double varianceValue = maskedImage.getVariance()->get(position, afw::image::PARENT);
+            double imageValue = maskedImage.getImage()->get(position, afw::image::PARENT);
+            if(!isfinite(1/varianceValue) || !isfinite(imageValue)) {
+                continue;
+            }
+            double psfValue = psfImage->get(position, afw::image::PARENT);
+            weightedSum += psfValue*imageValue/varianceValue;
+            psfNorm += psfValue*psfValue/varianceValue;
+        }
+    }
+    return (psfNorm > 0) ? static_cast<MatrixT>(weightedSum/psfNorm) : MatrixT();
+}
+
+template <typename PixelT, typename MatrixT>
+int CrowdedFieldMatrix<PixelT, MatrixT>::_fluxParameter(int epoch) {
+    if(epoch < 0 || epoch >= static_cast<int>(_exposures.size())) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::OutOfRangeError, "Requested epoch does not exist.");
+    }
+    return _sharedFlux ? 0 : epoch;
+}
+
+template <typename PixelT, typename MatrixT>
+void CrowdedFieldMatrix<PixelT, MatrixT>::_addSource(const afw::image::Exposure<PixelT> &exposure,
+                                            std::vector<Eigen::Triplet<MatrixT>> &matrixEntries,
+                                            int nStar, double x, double y, MatrixT estFlux, int epoch) {
     using afw::image::Image;
     using afw::image::Mask;
     using afw::image::MaskPixel;
@@ -150,31 +269,36 @@ void CrowdedFieldMatrix<PixelT>::_addSource(const afw::image::Exposure<PixelT> &
                 continue;
             }
 
-            PixelT psfValue = psfImage->get(geom::Point2I(x, y), afw::image::LOCAL);
+            MatrixT psfValue = psfImage->get(geom::Point2I(x, y), afw::image::LOCAL);
 
             int pixelIndex = _paramTracker.makePixelId(psfShapedVariance.indexToPosition(x, afw::image::X),
-                                                       psfShapedVariance.indexToPosition(y, afw::image::Y));
+                                                       psfShapedVariance.indexToPosition(y, afw::image::Y),
+                                                       epoch);
+
 
+            if(pixelIndex == static_cast<int>(_pixelWeights.size())) {
+                _pixelWeights.push_back(1.0/varianceValue);
+            }
 
-            int paramIndex = _paramTracker.getSourceParameterId(nStar, 0);
+            int paramIndex = _paramTracker.getSourceParameterId(nStar, _fluxParameter(epoch));
 
-            matrixEntries.push_back(Eigen::Triplet<PixelT>(pixelIndex, paramIndex, psfValue/varianceValue));
+            matrixEntries.push_back(Eigen::Triplet<MatrixT>(pixelIndex, paramIndex, psfValue/varianceValue));
             n_entries += 1;
 
             if(_fitCentroids && (x + pixelShift_dx >= 0) && (x + pixelShift_dx < psfImage->getWidth())) {
-                PixelT psfValue_dx = psfImage->get(geom::Point2I(x + pixelShift_dx, y), afw::image::LOCAL);
-                PixelT deriv_x = estFlux/varianceValue * (psfValue - psfValue_dx)/pixelNudge;
+                MatrixT psfValue_dx = psfImage->get(geom::Point2I(x + pixelShift_dx, y), afw::image::LOCAL);
+                MatrixT deriv_x = estFlux/varianceValue * (psfValue - psfValue_dx)/pixelNudge;
 
-                int paramIndex = _paramTracker.getSourceParameterId(nStar, 1);
-                matrixEntries.push_back(Eigen::Triplet<PixelT>(pixelIndex, paramIndex, deriv_x));
+                int paramIndex = _paramTracker.getSourceParameterId(nStar, _nFluxParameters);
+                matrixEntries.push_back(Eigen::Triplet<MatrixT>(pixelIndex, paramIndex, deriv_x));
             }
 
             if(_fitCentroids && (y + pixelShift_dy >= 0) && (y + pixelShift_dy < psfImage->getHeight())) {
-                PixelT psfValue_dy = psfImage->get(geom::Point2I(x, y + pixelShift_dy), afw::image::LOCAL);
-                PixelT deriv_y = estFlux/varianceValue * (psfValue - psfValue_dy)/pixelNudge;
+                MatrixT psfValue_dy = psfImage->get(geom::Point2I(x, y + pixelShift_dy), afw::image::LOCAL);
+                MatrixT deriv_y = estFlux/varianceValue * (psfValue - psfValue_dy)/pixelNudge;
 
-                int paramIndex = _paramTracker.getSourceParameterId(nStar, 2);
-                matrixEntries.push_back(Eigen::Triplet<PixelT>(pixelIndex, paramIndex, deriv_y));
+                int paramIndex = _paramTracker.getSourceParameterId(nStar, _nFluxParameters + 1);
+                matrixEntries.push_back(Eigen::Triplet<MatrixT>(pixelIndex, paramIndex, deriv_y));
             }
 
         }
@@ -184,41 +308,43 @@ void CrowdedFieldMatrix<PixelT>::_addSource(const afw::image::Exposure<PixelT> &
     }
 }
 
-template <typename PixelT>
-const std::list<std::tuple<int, int, PixelT>> CrowdedFieldMatrix<PixelT>::getMatrixEntries() {
-    std::list<std::tuple<int, int, PixelT>> output;
+template <typename PixelT, typename MatrixT>
+const std::list<std::tuple<int, int, MatrixT>> CrowdedFieldMatrix<PixelT, MatrixT>::getMatrixEntries() {
+    std::list<std::tuple<int, int, MatrixT>> output;
     for (auto ptr = _matrixEntries.begin(); ptr < _matrixEntries.end(); ++ptr) {
-        output.push_back(std::tuple<int, int, PixelT>(ptr->col(), ptr->row(), ptr->value()));
+        output.push_back(std::tuple<int, int, MatrixT>(ptr->col(), ptr->row(), ptr->value()));
     }
     return output;
 }
 
-template <typename PixelT>
-const Eigen::Matrix<PixelT, Eigen::Dynamic, 1> CrowdedFieldMatrix<PixelT>::getDataVector() {
+template <typename PixelT, typename MatrixT>
+const Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> CrowdedFieldMatrix<PixelT, MatrixT>::getDataVector() {
     return _dataVector;
 }
 
-template <typename PixelT>
-const Eigen::Matrix<PixelT, Eigen::Dynamic, 1> CrowdedFieldMatrix<PixelT>::makeDataVector() {
+template <typename PixelT, typename MatrixT>
+const Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> CrowdedFieldMatrix<PixelT, MatrixT>::makeDataVector() {
 
-    Eigen::Matrix<PixelT, Eigen::Dynamic, 1> dataMatrix(_paramTracker.nRows(), 1);
-    auto img = _exposure.getMaskedImage();
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> dataMatrix(_paramTracker.nRows(), 1);
     int * pixelId;
 
     int inf_pixel=0;
     int inf_var=0;
-    for (int y = 0; y != img.getHeight(); ++y) {
-        for (auto pixel_ptr = img.row_begin(y), end = img.row_end(y), x = 0; pixel_ptr != end; ++pixel_ptr, ++x) {
+    for (size_t epoch = 0; epoch < _exposures.size(); ++epoch) {
+        auto img = _exposures[epoch].getMaskedImage();
+        for (int y = 0; y != img.getHeight(); ++y) {
+            for (auto pixel_ptr = img.row_begin(y), end = img.row_end(y), x = 0; pixel_ptr != end; ++pixel_ptr, ++x) {
 
-            pixelId = _paramTracker.getPixelId(x, y);
-            if(pixelId == NULL) {
-                continue;
-            }
-            dataMatrix(*pixelId, 0) = pixel_ptr.image()/pixel_ptr.variance();
+                pixelId = _paramTracker.getPixelId(x + img.getX0(), y + img.getY0(), epoch);
+                if(pixelId == NULL) {
+                    continue;
+                }
+                dataMatrix(*pixelId, 0) = static_cast<MatrixT>(pixel_ptr.image())/pixel_ptr.variance();
 
-            if(!isfinite(pixel_ptr.image())) { inf_pixel += 1; };
-            if(!isfinite(pixel_ptr.variance())) { inf_var += 1; };
+                if(!isfinite(pixel_ptr.image())) { inf_pixel += 1; };
+                if(!isfinite(pixel_ptr.variance())) { inf_var += 1; };
 
+            }
         }
     }
     if((inf_pixel > 0) || (inf_var > 0)) {
@@ -227,39 +353,161 @@ const Eigen::Matrix<PixelT, Eigen::Dynamic, 1> CrowdedFieldMatrix<PixelT>::makeD
     return dataMatrix;
 }
 
-template <typename PixelT>
-SolverStatus CrowdedFieldMatrix<PixelT>::solve() {
+template <typename PixelT, typename MatrixT>
+void CrowdedFieldMatrix<PixelT, MatrixT>::_buildMatrix() {
+
+    _paramMatrix = Eigen::SparseMatrix<MatrixT>(_paramTracker.nRows(),
+                                               _paramTracker.nColumns());
+    _paramMatrix.setFromTriplets(_matrixEntries.begin(), _matrixEntries.end());
+    _paramMatrix.makeCompressed();
+
+    const int *innerIndex = _paramMatrix.innerIndexPtr();
+    const int *outerIndex = _paramMatrix.outerIndexPtr();
+    _valueIndex.resize(_matrixEntries.size());
+    for(size_t k = 0; k < _matrixEntries.size(); ++k) {
+        int col = _matrixEntries[k].col();
+        const int *entry = std::lower_bound(innerIndex + outerIndex[col],
+                                            innerIndex + outerIndex[col + 1],
+                                            _matrixEntries[k].row());
+        _valueIndex[k] = entry - innerIndex;
+    }
+    _matrixIsBuilt = true;
+}
+
+template <typename PixelT, typename MatrixT>
+bool CrowdedFieldMatrix<PixelT, MatrixT>::_hasSamePattern(const std::vector<Eigen::Triplet<MatrixT>> &matrixEntries) {
+    if(matrixEntries.size() != _matrixEntries.size()) {
+        return false;
+    }
+    for(size_t k = 0; k < matrixEntries.size(); ++k) {
+        if((matrixEntries[k].row() != _matrixEntries[k].row()) ||
+           (matrixEntries[k].col() != _matrixEntries[k].col())) {
+            return false;
+        }
+    }
+    return true;
+}
+
+template <typename PixelT, typename MatrixT>
+bool CrowdedFieldMatrix<PixelT, MatrixT>::updateCatalog(afw::table::SourceCatalog *catalog) {
+    if(catalog == NULL) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::RuntimeError, "sourceCatalog is NULL");
+    }
+    _catalog = catalog;
+
+    if(_matrixIsBuilt && static_cast<int>(catalog->size()) == _paramTracker.nSources()) {
+        int nRows = _paramTracker.nRows();
+        std::vector<Eigen::Triplet<MatrixT>> matrixEntries = _makeMatrixEntries(_exposures, catalog);
+
+        // No new pixels were mapped, so the data vector is unchanged too.
+        if((_paramTracker.nRows() == nRows) && _hasSamePattern(matrixEntries)) {
+            MatrixT *values = _paramMatrix.valuePtr();
+            std::fill(values, values + _paramMatrix.nonZeros(), MatrixT());
+            for(size_t k = 0; k < matrixEntries.size(); ++k) {
+                values[_valueIndex[k]] += matrixEntries[k].value();
+            }
+            _matrixEntries.swap(matrixEntries);
+            _useWarmStart = true;
+            LOGL_DEBUG(_log, "Reusing sparse matrix structure");
+            return true;
+        }
+
+        // The sources are the same but cover different pixels. The new
+        // entries are already complete: the tracker has mapped every pixel
+        // they need, so only the data vector and the compressed matrix are
+        // rebuilt. Pixels no longer covered by any source remain as empty
+        // rows, which do not change the solution.
+        LOGL_DEBUG(_log, "Rebuilding sparse matrix from updated entries");
+        _matrixEntries.swap(matrixEntries);
+        _dataVector = makeDataVector();
+        _matrixIsBuilt = false;
+        _useWarmStart = true;
+        return false;
+    }
+
+    LOGL_DEBUG(_log, "Rebuilding sparse matrix structure");
+    _paramTracker = ParameterTracker(_nFluxParameters + (_fitCentroids ? 2 : 0));
+    _pixelWeights.clear();
+    _matrixEntries = _makeMatrixEntries(_exposures, catalog);
+    _dataVector = makeDataVector();
+    _matrixIsBuilt = false;
+    _useWarmStart = false;
+    return false;
+}
 
+template <typename PixelT, typename MatrixT>
+void CrowdedFieldMatrix<PixelT, MatrixT>::setFluxErrKey(afw::table::Key<double> fluxErrKey) {
+    _fluxErrKey = fluxErrKey;
+}
 
-    Eigen::SparseMatrix<PixelT> paramMatrix;
+template <typename PixelT, typename MatrixT>
+SolverStatus CrowdedFieldMatrix<PixelT, MatrixT>::solve() {
 
     LOGL_INFO(_log, "parameter matrix size %i rows, %i cols",
               _paramTracker.nRows(), _paramTracker.nColumns());
 
-    paramMatrix = Eigen::SparseMatrix<PixelT>(_paramTracker.nRows(),
-                                              _paramTracker.nColumns());
-    paramMatrix.setFromTriplets(_matrixEntries.begin(), _matrixEntries.end());
+    if(!_matrixIsBuilt) {
+        _buildMatrix();
+    }
 
-    Eigen::LeastSquaresConjugateGradient<Eigen::SparseMatrix<PixelT>> lscg;
-    lscg.setTolerance(1e-6);
-    lscg.setMaxIterations(_maxIterations);
-    lscg.compute(paramMatrix);
-    _result = lscg.solve(_dataVector);
+    bool useGuess = _useWarmStart && (_result.size() == _paramTracker.nColumns());
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> guess;
+    if(useGuess) {
+        // Start from the previous fluxes. Centroid offsets were already
+        // applied to the catalog, so those start again from zero.
+        guess = _result;
+        if(_fitCentroids) {
+            for(int n = 0; n < _paramTracker.nSources(); ++n) {
+                guess(_paramTracker.getSourceParameterId(n, _nFluxParameters)) = MatrixT();
+                guess(_paramTracker.getSourceParameterId(n, _nFluxParameters + 1)) = MatrixT();
+            }
+        }
+    }
+    _useWarmStart = false;
+
+    if(_mixedPrecision) {
+        Eigen::VectorXd guessD;
+        if(useGuess) {
+            guessD = guess.template cast<double>();
+        } else {
+            guessD = Eigen::VectorXd::Zero(_paramTracker.nColumns());
+        }
+        _result = _solveMixedPrecision(guessD).template cast<MatrixT>();
+    } else {
+        Eigen::LeastSquaresConjugateGradient<Eigen::SparseMatrix<MatrixT>> lscg;
+        lscg.setTolerance(1e-6);
+        lscg.setMaxIterations(_maxIterations);
+        lscg.compute(_paramMatrix);
+
+        if(useGuess) {
+            _result = lscg.solveWithGuess(_dataVector, guess);
+        } else {
+            _result = lscg.solve(_dataVector);
+        }
+        _iterations = lscg.iterations();
+    }
 
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> fluxVariance;
+    if(_catalog && _fluxErrKey.isValid()) {
+        fluxVariance = computeFluxVariance();
+    }
 
     if(_catalog) {
         size_t n = 0;
         for(auto rec = _catalog->begin(); rec < _catalog->end(); ++rec, ++n) {
-            rec->set(_fluxKey, _result(_paramTracker.getSourceParameterId(n, 0), 0));
+            rec->set(_fluxKey, _result(_paramTracker.getSourceParameterId(n, _fluxParameter(0)), 0));
+            if(_fluxErrKey.isValid()) {
+                rec->set(_fluxErrKey, std::sqrt(fluxVariance(n)));
+            }
             if(_fitCentroids && _centroidKey.isValid()) {
-                auto deltaCentroid = geom::Extent2D(_result(_paramTracker.getSourceParameterId(n, 1), 0),
-                                                    _result(_paramTracker.getSourceParameterId(n, 2), 0));
+                auto deltaCentroid = geom::Extent2D(
+                    _result(_paramTracker.getSourceParameterId(n, _nFluxParameters), 0),
+                    _result(_paramTracker.getSourceParameterId(n, _nFluxParameters + 1), 0));
                 rec->set(_centroidKey, rec->getCentroid() + deltaCentroid);
             }
         }
     }
 
-    _iterations = lscg.iterations();
     if(_iterations == _maxIterations) {
         LOGL_WARN(_log, "eigen failed to solve in %i iterations", _iterations);
         return SolverStatus::FAILURE;
@@ -270,22 +518,199 @@ SolverStatus CrowdedFieldMatrix<PixelT>::solve() {
 
 }
 
-template <typename PixelT>
-Eigen::Matrix<PixelT, Eigen::Dynamic, 1> CrowdedFieldMatrix<PixelT>::result() {
+template <typename PixelT, typename MatrixT>
+void CrowdedFieldMatrix<PixelT, MatrixT>::setMixedPrecision(bool mixedPrecision) {
+    _mixedPrecision = mixedPrecision;
+}
+
+/*
+ * Jacobi-preconditioned CGLS, following Eigen's LeastSquaresConjugateGradient
+ * (same stopping criterion |A^T r| < tol |A^T b|), but with the matrix read at
+ * its stored precision and all vectors and accumulations kept in double. This
+ * keeps the memory footprint of a single precision matrix while avoiding the
+ * loss of precision in the residuals for fields with a large flux range.
+ */
+template <typename PixelT, typename MatrixT>
+Eigen::VectorXd CrowdedFieldMatrix<PixelT, MatrixT>::_solveMixedPrecision(const Eigen::VectorXd &guess) {
+
+    const double tolerance = 1e-6;
+    const int nCols = _paramMatrix.cols();
+    const int nRows = _paramMatrix.rows();
+
+    auto multiply = [&](const Eigen::VectorXd &vec, Eigen::VectorXd &out) {
+        out.setZero(nRows);
+        for(int k = 0; k < nCols; ++k) {
+            for(typename Eigen::SparseMatrix<MatrixT>::InnerIterator it(_paramMatrix, k); it; ++it) {
+                out(it.row()) += static_cast<double>(it.value())*vec(k);
+            }
+        }
+    };
+    auto multiplyTranspose = [&](const Eigen::VectorXd &vec, Eigen::VectorXd &out) {
+        out.setZero(nCols);
+        for(int k = 0; k < nCols; ++k) {
+            double sum = 0.0;
+            for(typename Eigen::SparseMatrix<MatrixT>::InnerIterator it(_paramMatrix, k); it; ++it) {
+                sum += static_cast<double>(it.value())*vec(it.row());
+            }
+            out(k) = sum;
+        }
+    };
+
+    Eigen::VectorXd invDiag(nCols);
+    for(int k = 0; k < nCols; ++k) {
+        double norm2 = 0.0;
+        for(typename Eigen::SparseMatrix<MatrixT>::InnerIterator it(_paramMatrix, k); it; ++it) {
+            norm2 += static_cast<double>(it.value())*static_cast<double>(it.value());
+        }
+        invDiag(k) = (norm2 > 0.0) ? 1.0/norm2 : 1.0;
+    }
+
+    Eigen::VectorXd rhs = _dataVector.template cast<double>();
+    Eigen::VectorXd x = guess;
+    Eigen::VectorXd tmp, residual, normalResidual;
+
+    multiplyTranspose(rhs, tmp);
+    double rhsNorm2 = tmp.squaredNorm();
+    if(rhsNorm2 == 0) {
+        _iterations = 0;
+        return Eigen::VectorXd::Zero(nCols);
+    }
+    double threshold = tolerance*tolerance*rhsNorm2;
+
+    multiply(x, tmp);
+    residual = rhs - tmp;
+    multiplyTranspose(residual, normalResidual);
+    if(normalResidual.squaredNorm() < threshold) {
+        _iterations = 0;
+        return x;
+    }
+
+    Eigen::VectorXd p = invDiag.cwiseProduct(normalResidual);
+    Eigen::VectorXd z;
+    double absNew = normalResidual.dot(p);
+
+    int i = 0;
+    while(i < _maxIterations) {
+        multiply(p, tmp);
+        double alpha = absNew/tmp.squaredNorm();
+        x += alpha*p;
+        residual -= alpha*tmp;
+        multiplyTranspose(residual, normalResidual);
+        if(normalResidual.squaredNorm() < threshold) {
+            break;
+        }
+        z = invDiag.cwiseProduct(normalResidual);
+        double absOld = absNew;
+        absNew = normalResidual.dot(z);
+        p = z + (absNew/absOld)*p;
+        ++i;
+    }
+    _iterations = i;
+    return x;
+}
+
+template <typename PixelT, typename MatrixT>
+int CrowdedFieldMatrix<PixelT, MatrixT>::iterations() {
+    return _iterations;
+}
+
+/*
+ * Per-source flux variances from the sparse system, without a dense inverse.
+ *
+ * The rows of the matrix A and data vector b are weighted by 1/variance, so
+ * Cov(b) = W = diag(1/variance) and the least-squares solution has covariance
+ * (A^T A)^-1 A^T W A (A^T A)^-1. Each source is only coupled to the sources
+ * whose footprints overlap its own, so the flux variance is evaluated from
+ * the block of that expression restricted to those neighbouring parameters.
+ * This neglects coupling beyond the nearest neighbours, and the cost scales
+ * linearly with the number of sources at fixed source density.
+ */
+template <typename PixelT, typename MatrixT>
+Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> CrowdedFieldMatrix<PixelT, MatrixT>::computeFluxVariance(int epoch) {
+
+    if(!_matrixIsBuilt) {
+        _buildMatrix();
+    }
+    Eigen::SparseMatrix<double> paramMatrix = _paramMatrix.template cast<double>();
+
+    Eigen::Map<const Eigen::VectorXd> weights(_pixelWeights.data(), _pixelWeights.size());
+    Eigen::SparseMatrix<double> weightedMatrix = weights.asDiagonal() * paramMatrix;
+    Eigen::SparseMatrix<double> normalMatrix = paramMatrix.transpose() * paramMatrix;
+    Eigen::SparseMatrix<double> covarianceMatrix = paramMatrix.transpose() * weightedMatrix;
+
+    int nSources = _paramTracker.nSources();
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> variance(nSources);
+
+    for(int n = 0; n < nSources; ++n) {
+        int column = _paramTracker.getSourceParameterId(n, _fluxParameter(epoch));
+
+        std::vector<int> neighbors;
+        int localIndex = -1;
+        for(Eigen::SparseMatrix<double>::InnerIterator it(normalMatrix, column); it; ++it) {
+            if(it.row() == column) {
+                localIndex = neighbors.size();
+            }
+            neighbors.push_back(it.row());
+        }
+
+        if(localIndex < 0) {
+            // No unmasked pixels constrain this source.
+            variance(n) = std::numeric_limits<MatrixT>::quiet_NaN();
+            continue;
+        }
+
+        int nLocal = neighbors.size();
+        Eigen::MatrixXd localNormal(nLocal, nLocal);
+        Eigen::MatrixXd localCovariance(nLocal, nLocal);
+        for(int i = 0; i < nLocal; ++i) {
+            for(int j = 0; j < nLocal; ++j) {
+                localNormal(i, j) = normalMatrix.coeff(neighbors[i], neighbors[j]);
+                localCovariance(i, j) = covarianceMatrix.coeff(neighbors[i], neighbors[j]);
+            }
+        }
+
+        Eigen::VectorXd unitVector = Eigen::VectorXd::Zero(nLocal);
+        unitVector(localIndex) = 1.0;
+        Eigen::VectorXd inverseColumn = localNormal.ldlt().solve(unitVector);
+        variance(n) = inverseColumn.dot(localCovariance * inverseColumn);
+    }
+
+    return variance;
+}
+
+template <typename PixelT, typename MatrixT>
+Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> CrowdedFieldMatrix<PixelT, MatrixT>::result() {
     return _result;
 }
 
-template <typename PixelT>
-const std::map<std::tuple<int, int>, int> CrowdedFieldMatrix<PixelT>::getParameterMapping() {
+template <typename PixelT, typename MatrixT>
+Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> CrowdedFieldMatrix<PixelT, MatrixT>::getFluxes(int epoch) {
+    int nSources = _paramTracker.nSources();
+    int fluxParameter = _fluxParameter(epoch);
+    Eigen::Matrix<MatrixT, Eigen::Dynamic, 1> fluxes(nSources);
+    for(int n = 0; n < nSources; ++n) {
+        fluxes(n) = _result(_paramTracker.getSourceParameterId(n, fluxParameter), 0);
+    }
+    return fluxes;
+}
+
+template <typename PixelT, typename MatrixT>
+int CrowdedFieldMatrix<PixelT, MatrixT>::nEpochs() {
+    return _exposures.size();
+}
+
+template <typename PixelT, typename MatrixT>
+const std::map<std::tuple<int, int>, int> CrowdedFieldMatrix<PixelT, MatrixT>::getParameterMapping() {
     return _paramTracker.getParameterMapping();
 }
 
-template <typename PixelT>
-const std::map<std::tuple<int, int>, int> CrowdedFieldMatrix<PixelT>::getPixelMapping() {
-    return _paramTracker.getPixelMapping();
+template <typename PixelT, typename MatrixT>
+const std::map<std::tuple<int, int>, int> CrowdedFieldMatrix<PixelT, MatrixT>::getPixelMapping(int epoch) {
+    return _paramTracker.getPixelMapping(epoch);
 }
 
-template class CrowdedFieldMatrix<float>;
+template class CrowdedFieldMatrix<float, float>;
+template class CrowdedFieldMatrix<float, double>;
 
 
 } // namespace crowd
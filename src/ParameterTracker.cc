@@ -12,7 +12,9 @@ namespace crowd {
 
 ParameterTracker::ParameterTracker(int nParameters) :
     _nParameters(nParameters),
-    _pixelMapping(std::map<std::tuple<int, int>, int>()),
+    _nSources(0),
+    _nPixels(0),
+    _pixelMappings(std::vector<std::map<std::tuple<int, int>, int>>()),
     _sourceParameterMapping(std::map<std::tuple<int, int>, int>())
 {
 }
@@ -21,6 +23,10 @@ void ParameterTracker::addSource(int sourceId) {
 
     int nextParameterId;
 
+    if(_sourceParameterMapping.find(std::make_tuple(sourceId, 0)) == _sourceParameterMapping.end()) {
+        _nSources += 1;
+    }
+
     for(int i = 0; i < _nParameters; i++) {
         nextParameterId = _sourceParameterMapping.size();
         _sourceParameterMapping.insert({std::make_tuple(sourceId, i),
@@ -33,24 +39,33 @@ void ParameterTracker::addSource(int sourceId) {
  * because we expect this to get built up before solving and
  * then not need to be accessed again.
  */
-int ParameterTracker::makePixelId(int pixelX, int pixelY) {
+int ParameterTracker::makePixelId(int pixelX, int pixelY, int epoch) {
 
     int newPixelId;
-    auto pixelMapEntry = _pixelMapping.find(std::make_tuple(pixelX, pixelY));
+    if(epoch >= static_cast<int>(_pixelMappings.size())) {
+        _pixelMappings.resize(epoch + 1);
+    }
+    auto &pixelMapping = _pixelMappings[epoch];
+    auto pixelMapEntry = pixelMapping.find(std::make_tuple(pixelX, pixelY));
 
-    if(pixelMapEntry != _pixelMapping.end()) {
+    if(pixelMapEntry != pixelMapping.end()) {
         return pixelMapEntry->second;
     } else {
-        newPixelId = _pixelMapping.size();
-        _pixelMapping.insert({std::make_tuple(pixelX, pixelY), newPixelId});
+        newPixelId = _nPixels;
+        _nPixels += 1;
+        pixelMapping.insert({std::make_tuple(pixelX, pixelY), newPixelId});
         return newPixelId;
     }
 
 }
 
-int* ParameterTracker::getPixelId(int pixelX, int pixelY) {
-    auto pixelMapEntry = _pixelMapping.find(std::make_tuple(pixelX, pixelY));
-    if(pixelMapEntry != _pixelMapping.end()) {
+int* ParameterTracker::getPixelId(int pixelX, int pixelY, int epoch) {
+    if(epoch >= static_cast<int>(_pixelMappings.size())) {
+        return NULL;
+    }
+    auto &pixelMapping = _pixelMappings[epoch];
+    auto pixelMapEntry = pixelMapping.find(std::make_tuple(pixelX, pixelY));
+    if(pixelMapEntry != pixelMapping.end()) {
         return &pixelMapEntry->second;
     } else {
         return NULL;
@@ -70,18 +85,25 @@ std::map<std::tuple<int, int>, int> ParameterTracker::getParameterMapping() {
     return _sourceParameterMapping;
 }
 
-std::map<std::tuple<int, int>, int> ParameterTracker::getPixelMapping() {
-    return _pixelMapping;
+std::map<std::tuple<int, int>, int> ParameterTracker::getPixelMapping(int epoch) {
+    if(epoch >= static_cast<int>(_pixelMappings.size())) {
+        return std::map<std::tuple<int, int>, int>();
+    }
+    return _pixelMappings[epoch];
 }
 
 int ParameterTracker::nRows() {
-    return _pixelMapping.size();
+    return _nPixels;
 }
 
 int ParameterTracker::nColumns() {
     return _sourceParameterMapping.size();
 }
 
+int ParameterTracker::nSources() {
+    return _nSources;
+}
+
 }
 }
 }
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import lsst.utils.tests
+import lsst.geom as geom
+from lsst.afw.image import ExposureF
+from lsst.afw.geom import makeSkyWcs, makeCdMatrix
+from lsst.meas.algorithms.installGaussianPsf import InstallGaussianPsfTask, InstallGaussianPsfConfig
+from lsst.pipe.crowd import CrowdedFieldTask, CrowdedFieldTaskConfig, matchPositions
+
+from test_matrix_creation import add_psf_image
+
+
+def make_exposure():
+    exposure = ExposureF(300, 300)
+    psfConfig = InstallGaussianPsfConfig()
+    psfConfig.fwhm = 4
+    psfTask = InstallGaussianPsfTask(config=psfConfig)
+    psfTask.run(exposure=exposure)
+
+    variance_image = exposure.getMaskedImage().getVariance()
+    variance_image += 50
+
+    exposure.setWcs(makeSkyWcs(crpix=geom.Point2D(150.0, 150.0),
+                               crval=geom.SpherePoint(150.0, 2.0, geom.degrees),
+                               cdMatrix=makeCdMatrix(scale=0.2*geom.arcseconds)))
+
+    # Several stars sit on or next to the x = 150 and y = 150 tile edges.
+    rng = np.random.RandomState(12)
+    x = np.concatenate([[149.8, 150.3, 60.0, 240.0, 149.9], rng.uniform(10, 290, 20)])
+    y = np.concatenate([[60.0, 230.0, 150.2, 149.7, 150.1], rng.uniform(10, 290, 20)])
+    flux = rng.uniform(2000.0, 5000.0, len(x))
+    for xx, yy, ff in zip(x, y, flux):
+        add_psf_image(exposure, xx, yy, ff)
+
+    return exposure
+
+
+class CrowdedFieldTaskTestCase(lsst.utils.tests.TestCase):
+
+    def runTask(self, **config_overrides):
+        config = CrowdedFieldTaskConfig()
+        for name, value in config_overrides.items():
+            setattr(config, name, value)
+        task = CrowdedFieldTask(config=config)
+        return task.run(make_exposure())
+
+    def test_tiling(self):
+        untiled = self.runTask().crowdedFieldCat
+        tiled = self.runTask(doTiling=True, tileSize=150, tileBorder=32).crowdedFieldCat
+
+        self.assertEqual(len(tiled), len(untiled))
+
+        idx1, idx2, distance = matchPositions(
+            np.stack([untiled["centroid_x"], untiled["centroid_y"]], axis=1),
+            np.stack([tiled["centroid_x"], tiled["centroid_y"]], axis=1), 0.5)
+        self.assertEqual(len(idx1), len(untiled))
+        self.assertFloatsAlmostEqual(tiled["crowd_psfFlux_flux_instFlux"][idx2],
+                                     untiled["crowd_psfFlux_flux_instFlux"][idx1], rtol=1e-2)
+
+    def assertSameResult(self, result1, result2):
+        catalog1, catalog2 = result1.crowdedFieldCat, result2.crowdedFieldCat
+        self.assertEqual(len(catalog1), len(catalog2))
+        np.testing.assert_array_equal(catalog1["id"], catalog2["id"])
+        self.assertEqual(len(np.unique(catalog1["id"])), len(catalog1))
+        for name in ("centroid_x", "centroid_y", "crowd_psfFlux_flux_instFlux"):
+            self.assertFloatsEqual(catalog1[name], catalog2[name])
+        self.assertImagesEqual(result1.crowdedFieldResidual.getMaskedImage().getImage(),
+                               result2.crowdedFieldResidual.getMaskedImage().getImage())
+        self.assertMasksEqual(result1.crowdedFieldResidual.getMaskedImage().getMask(),
+                              result2.crowdedFieldResidual.getMaskedImage().getMask())
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            uninterrupted = self.runTask(num_iterations=2,
+                                         checkpointDir=os.path.join(checkpoint_dir, "full"))
+
+            resume_dir = os.path.join(checkpoint_dir, "resumed")
+            self.runTask(num_iterations=1, checkpointDir=resume_dir)
+            resumed = self.runTask(num_iterations=2, checkpointDir=resume_dir, doResume=True)
+            self.assertSameResult(resumed, uninterrupted)
+
+            # peak_significance_cutoff only applies from round 2 on, so the
+            # first-round checkpoint is still used when it changes.
+            cutoff_uninterrupted = self.runTask(num_iterations=2, peak_significance_cutoff=0.8)
+            cutoff_resumed = self.runTask(num_iterations=2, peak_significance_cutoff=0.8,
+                                          checkpointDir=resume_dir, doResume=True)
+            self.assertSameResult(cutoff_resumed, cutoff_uninterrupted)
@@ -0,0 +1,86 @@
+import unittest
+import numpy as np
+import lsst.utils.tests
+import lsst.afw.table as afwTable
+import lsst.geom as geom
+from lsst.afw.image import ExposureF
+from lsst.afw.geom import makeSkyWcs, makeCdMatrix
+from lsst.meas.algorithms.installGaussianPsf import InstallGaussianPsfTask, InstallGaussianPsfConfig
+from lsst.pipe.crowd import CrowdedFieldForcedTask
+
+from test_matrix_creation import add_psf_image
+
+
+class CrowdedFieldForcedTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.exposure = ExposureF(300, 300)
+        psfConfig = InstallGaussianPsfConfig()
+        psfConfig.fwhm = 4
+        psfTask = InstallGaussianPsfTask(config=psfConfig)
+        psfTask.run(exposure=self.exposure)
+
+        variance_image = self.exposure.getMaskedImage().getVariance()
+        variance_image += 50
+
+        self.wcs = makeSkyWcs(crpix=geom.Point2D(150.0, 150.0),
+                              crval=geom.SpherePoint(150.0, 2.0, geom.degrees),
+                              cdMatrix=makeCdMatrix(scale=0.2*geom.arcseconds))
+        self.exposure.setWcs(self.wcs)
+
+    def test_forcedFluxes(self):
+        x = np.array([100.3, 108.0, 200.6])
+        y = np.array([120.2, 121.5, 40.1])
+        flux = np.array([600.0, 300.0, 450.0])
+        for xx, yy, ff in zip(x, y, flux):
+            add_psf_image(self.exposure, xx, yy, ff)
+
+        refCat = afwTable.SourceCatalog(afwTable.SourceTable.makeMinimalSchema())
+        for n, (xx, yy) in enumerate(zip(x, y)):
+            record = refCat.addNew()
+            record.setId(100 + n)
+            record.setCoord(self.wcs.pixelToSky(xx, yy))
+        # Off the exposure; should not be fit.
+        record = refCat.addNew()
+        record.setId(200)
+        record.setCoord(self.wcs.pixelToSky(-500.0, 150.0))
+
+        task = CrowdedFieldForcedTask()
+        result = task.run(self.exposure, refCat)
+        catalog = result.crowdedFieldCat
+
+        self.assertEqual(len(catalog), 3)
+        np.testing.assert_array_equal(catalog["objectId"], [100, 101, 102])
+        self.assertFloatsAlmostEqual(catalog["centroid_x"], x, atol=1e-6)
+        self.assertFloatsAlmostEqual(catalog["centroid_y"], y, atol=1e-6)
+        self.assertFloatsAlmostEqual(catalog["crowd_psfFlux_flux_instFlux"], flux, rtol=1e-4)
+        self.assertTrue(np.all(catalog["crowd_psfFlux_flux_instFluxErr"] > 0))
+
+    def test_multiplePatches(self):
+        x = np.array([100.3, 200.6])
+        y = np.array([120.2, 40.1])
+        flux = np.array([600.0, 450.0])
+        for xx, yy, ff in zip(x, y, flux):
+            add_psf_image(self.exposure, xx, yy, ff)
+
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        schema.addField("detect_isPrimary", type="Flag", doc="Primary detection")
+        refCats = []
+        # Each patch contains both sources, but each is primary in only one.
+        for patch in range(2):
+            refCat = afwTable.SourceCatalog(schema)
+            for n, (xx, yy) in enumerate(zip(x, y)):
+                record = refCat.addNew()
+                record.setId(100 + n)
+                record.setCoord(self.wcs.pixelToSky(xx, yy))
+                record["detect_isPrimary"] = (n == patch)
+            refCats.append(refCat)
+
+        task = CrowdedFieldForcedTask()
+        refCat = task._concatenateRefCats(refCats)
+        self.assertTrue(refCat.isContiguous())
+        catalog = task.run(self.exposure, refCat).crowdedFieldCat
+
+        self.assertEqual(len(catalog), 2)
+        np.testing.assert_array_equal(catalog["objectId"], [100, 101])
+        self.assertFloatsAlmostEqual(catalog["crowd_psfFlux_flux_instFlux"], flux, rtol=1e-4)
@@ -0,0 +1,26 @@
+import unittest
+import numpy as np
+import lsst.utils.tests
+from lsst.pipe.crowd import matchPositions
+
+
+class MatchPositionsTestCase(lsst.utils.tests.TestCase):
+
+    def test_oneToOne(self):
+        positions1 = np.array([[0.0, 0.0], [10.0, 10.0], [10.5, 10.0], [50.0, 50.0]])
+        positions2 = np.array([[10.2, 10.0], [0.1, 0.0], [30.0, 30.0]])
+
+        idx1, idx2, distance = matchPositions(positions1, positions2, 1.0)
+
+        # Entries 1 and 2 both have positions2[0] as nearest neighbour; only
+        # the closer one (entry 1) keeps the match.
+        np.testing.assert_array_equal(idx1, [0, 1])
+        np.testing.assert_array_equal(idx2, [1, 0])
+        self.assertFloatsAlmostEqual(distance, np.array([0.1, 0.2]), atol=1e-12)
+
+    def test_empty(self):
+        idx1, idx2, distance = matchPositions(np.zeros((0, 2)), np.ones((3, 2)), 1.0)
+        self.assertEqual(len(idx1), 0)
+        self.assertEqual(len(idx2), 0)
+        self.assertEqual(len(distance), 0)
+
@@ -0,0 +1,52 @@
+import unittest
+import numpy as np
+import lsst.utils.tests
+import lsst.afw.table as afwTable
+import lsst.geom as geom
+from lsst.afw.image import ExposureF
+from lsst.meas.algorithms.installGaussianPsf import InstallGaussianPsfTask, InstallGaussianPsfConfig
+from lsst.pipe.crowd import ModelImageTask
+
+
+class ModelImageTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.exposure = ExposureF(300, 300)
+        psfConfig = InstallGaussianPsfConfig()
+        psfConfig.fwhm = 4
+        psfTask = InstallGaussianPsfTask(config=psfConfig)
+        psfTask.run(exposure=self.exposure)
+
+        variance_image = self.exposure.getMaskedImage().getVariance()
+        variance_image += 50
+
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        schema.addField("centroid_x", type=np.float64)
+        schema.addField("centroid_y", type=np.float64)
+        self.flux_key = schema.addField("flux_flux", type=np.float64)
+        schema.getAliasMap().set("slot_Centroid", "centroid")
+        self.catalog = afwTable.SourceCatalog(schema)
+
+        # Overlapping sources, some straddling the sub-region edges and the
+        # exposure edges.
+        rng = np.random.RandomState(5)
+        x = np.concatenate([[100.0, 101.5, 148.7, 2.0, 298.5], rng.uniform(0, 300, 40)])
+        y = np.concatenate([[100.0, 99.2, 151.3, 150.0, 10.0], rng.uniform(0, 300, 40)])
+        for xx, yy in zip(x, y):
+            record = self.catalog.addNew()
+            record["centroid_x"] = xx
+            record["centroid_y"] = yy
+            record[self.flux_key] = rng.uniform(100.0, 5000.0)
+
+    def test_makeModelExposure(self):
+        task = ModelImageTask()
+        model_image = task.run(self.exposure, self.catalog, self.flux_key)
+
+        full_bbox = self.exposure.getBBox()
+        sub_bbox = geom.Box2I(geom.Point2I(90, 120), geom.Extent2I(60, 40))
+        for bbox in (full_bbox, sub_bbox):
+            model_exposure = task.makeModelExposure(self.catalog, self.flux_key,
+                                                    self.exposure.getPsf(), bbox)
+            self.assertEqual(model_exposure.getBBox(), bbox)
+            self.assertImagesEqual(model_exposure.getMaskedImage().getImage(),
+                                   model_image.getImage()[bbox])